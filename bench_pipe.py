@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+
+Benchmarks for the pipeline's bookkeeping paths, run against synthetic file names so no
+grid endpoint is needed.
+
+    listing:  parse a globus-url-copy -list output and pair data files with their marker files
+              (transfer_pipeline.getfiles)
+    reconcile: match local against remote names, both sides of the given size and half of them
+              in common, as the clean_pipe passes do (clean_pipe.gone_from and done_in)
+
+Run as:  bench_pipe.py [--sizes 10000,100000,1000000] [--only listing|reconcile]
+
+"""
+
+import sys, time
+import argparse
+from transfer_pipeline import listing_pairs
+from clean_pipe import gone_from, done_in
+
+SIZES = "10000,100000,1000000"
+FTYPE = "daq"
+MRKTYPE = "mrk"
+DONETYPE = "done"
+
+
+def synthetic_listing(nentries):
+    """ guc -list style output with nentries names, about half of them data files paired with a marker """
+    lines = ["gsiftp://stargrid02.rcf.bnl.gov//star/data97/GRID/Cori/"]
+    for i in range(nentries // 2):
+        dfile = "st_physics_%08d_raw_%07d.%s" % (20000000 + i // 100, i, FTYPE)
+        lines.append("    %s" % (dfile))
+        if i % 10:   # --- every tenth data file still waits for its marker
+            lines.append("    %s.%s" % (dfile, MRKTYPE))
+    return "\n".join(lines)
+
+
+def bench_listing(nentries):
+    listing = synthetic_listing(nentries).splitlines(True)
+    t0 = time.time()
+    npairs = 0
+    pairs = listing_pairs(FTYPE, MRKTYPE)
+    for line in listing:   # --- as getfiles is handed the listing line by line
+        for afile in line.split():
+            if pairs.add(afile) is not None:
+                npairs += 1
+    elapsed = time.time() - t0
+    print "listing: %9d entries %9d pairs %8.3f s" % (nentries, npairs, elapsed)
+
+
+def bench_reconcile(nentries):
+    """ nentries local names against nentries remote ones, half of them on both sides """
+    names = ["st_physics_%08d_raw_%07d.%s" % (20000000 + i // 100, i, FTYPE) for i in range(nentries + nentries // 2)]
+    local, remote = names[:nentries], names[nentries // 2:]
+    remote_done = [".".join([name, DONETYPE]) for name in remote]
+    t0 = time.time()
+    ngone = len(gone_from(local, remote))
+    t1 = time.time()
+    ndone = len(done_in(local, iter(remote_done), DONETYPE))
+    t2 = time.time()
+    print "reconcile: %9d x %d entries %9d gone %8.3f s %9d done %8.3f s" % (nentries, nentries, ngone, t1 - t0, ndone, t2 - t1)
+
+
+BENCHES = dict(listing=bench_listing, reconcile=bench_reconcile)
+
+
+def main():
+    p = argparse.ArgumentParser(description=" Pipeline benchmarks ")
+    p.add_argument("--sizes", dest="sizes", default=SIZES, help="comma separated entry counts [%(default)s]")
+    p.add_argument("--only", dest="only", default="None", help="run only this benchmark: %s" % (", ".join(sorted(BENCHES))))
+    args = p.parse_args()
+
+    names = sorted(BENCHES)
+    if not args.only == "None":
+        if args.only not in BENCHES:
+            p.error("unknown benchmark %s" % (args.only))
+        names = [args.only]
+    for name in names:
+        for nentries in args.sizes.split(","):
+            BENCHES[name](int(nentries))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+Content verification of transferred files, done in a pool of verifier threads so the next
+transfer can run while the last file is hashed.
+
+Files are read sequentially in large blocks.  The expected checksum comes from the MRK file
+when it carries one, as a token "<algorithm>:<hex value>" after the size (e.g. "3 x adler32:0a1b2c3d");
+otherwise the checksum is only computed and logged.  Results are cached by (path, size, mtime)
+in a json file, so a file is never hashed twice.
+
+crc32c is not in the python standard library, zlib's crc32 is offered instead.
+"""
+import hashlib, os, threading, time, zlib, Queue
+from process_commands import load_json, save_json
+
+ALGORITHMS = ["adler32", "crc32", "md5"]
+READ_SIZE = 8 << 20   # bytes per read
+CACHE_KEEP = 20000    # cache entries kept
+
+
+def file_checksum(path, algorithm):
+    """ hex checksum of the file at path """
+    with open(path, "rb") as afile:
+        if algorithm == "md5":
+            digest = hashlib.md5()
+            for block in iter(lambda: afile.read(READ_SIZE), ""):
+                digest.update(block)
+            return digest.hexdigest()
+        update = algorithm == "adler32" and zlib.adler32 or zlib.crc32
+        value = algorithm == "adler32" and 1 or 0
+        for block in iter(lambda: afile.read(READ_SIZE), ""):
+            value = update(block, value)
+        return "%08x" % (value & 0xffffffff)
+
+
+def marker_checksum(mrkfile):
+    """ (algorithm, value) of the checksum token in a MRK file, None if it has none """
+    try:
+        with open(mrkfile) as mfile:
+            tokens = mfile.readline().split()[1:]
+    except IOError:
+        return None
+    for token in tokens:
+        algorithm, _sep, value = token.partition(":")
+        algorithm, value = algorithm.lower(), value.lower()
+        if algorithm in ALGORITHMS and value:
+            if algorithm != "md5":
+                value = value.zfill(8)
+            return algorithm, value
+    return None
+
+
+class checksum_pool:
+    """ verifier threads checking files against their expected checksum """
+
+    def __init__(self, nworkers, algorithm, cache_file, proc_c):
+        self.algorithm = algorithm
+        self.cache_file = cache_file
+        self.proc_c = proc_c
+        self.lock = threading.Lock()
+        self.cache = load_json(cache_file, {}).get("checksums", {})  # "path|size|mtime|algorithm" -> [value, time]
+        self.dirty = False
+        self.work = Queue.Queue()
+        for i in range(nworkers):
+            t = threading.Thread(target=self._worker, name="verify-%d" % (i))
+            t.daemon = True
+            t.start()
+
+    def submit(self, path, expected, done):
+        """ verify path against expected (algorithm, value) or None, then call done(ok, checksum) """
+        self.work.put((path, expected, done))
+
+    def join(self):
+        """ wait until every submitted file has been verified """
+        # --- Queue.join would block signal handlers of the main thread for the whole wait
+        with self.work.all_tasks_done:
+            while self.work.unfinished_tasks:
+                self.work.all_tasks_done.wait(1)
+
+    def checksum(self, path, algorithm):
+        """ checksum of path, from the cache while the file's size and mtime are unchanged """
+        st = os.stat(path)
+        key = "|".join([path, str(st.st_size), str(int(st.st_mtime)), algorithm])
+        with self.lock:
+            cached = self.cache.get(key)
+        if cached is not None:
+            return cached[0]
+        t0 = time.time()
+        value = file_checksum(path, algorithm)
+        elapsed = time.time() - t0
+        self.proc_c.log("%s %s of %s in %.1f secs (%.2f MB/sec)" % (algorithm, value, path, elapsed,
+                        st.st_size / float(1 << 20) / max(elapsed, 0.001)), 1)
+        with self.lock:
+            self.cache[key] = [value, int(time.time())]
+            self.dirty = True
+        return value
+
+    def _worker(self):
+        while True:
+            path, expected, done = self.work.get()
+            try:
+                algorithm = expected and expected[0] or self.algorithm
+                try:
+                    value = self.checksum(path, algorithm)
+                    ok = expected is None or value == expected[1]
+                except Exception as oops:
+                    self.proc_c.log("Can't checksum %s: %s" % (path, oops), 0)
+                    value, ok = None, False
+                if not ok and value is not None:
+                    self.proc_c.log("Checksum mismatch for %s: %s %s, expected %s" %
+                                    (path, algorithm, value, expected[1]), 0)
+                done(ok, value)
+            except Exception as oops:
+                self.proc_c.log("Verifier failed on %s: %s" % (path, oops), 0)
+            finally:
+                self.work.task_done()
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self.lock:
+            entries = sorted(self.cache.items(), key=lambda kv: kv[1][1])[-CACHE_KEEP:]
+            self.cache = dict(entries)
+            state = dict(checksums=dict((key, list(value)) for key, value in entries))
+            self.dirty = False
+        save_json(self.cache_file, state)
@@ -13,6 +13,15 @@ If no match is found, the remote site has removed the source file allowing the l
 "--clean-local-buffer", chechs the remote tranfer status area for a matching '.done' file.  When it is found,
 the local buffer's target file and '.mrk' file are removed.
 
+Each pass hashes one side once and streams the other against it (see gone_from and done_in), so 
+it takes time linear in the number of entries on both sides.
+
+Removals run in a pool of "--delete-workers" threads, capped at "--max-iops" operations per second 
+so the metadata servers keep up (see delete_pool.py).  A pass logs one summary line; the single 
+removals and failures are logged at verbosity 1.
+
+Removal counts and listing times are kept as prometheus metrics, served with "--metrics-port"
+and/or written to a node_exporter textfile with "--metrics-file".
 
 """
 
@@ -30,6 +39,12 @@ from subprocess import Popen, PIPE, STDOUT
 import argparse
 from ConfigParser import RawConfigParser
 from process_commands import process_commands
+from transfer_status import open_status
+from space_ledger import space_ledger
+from pipe_scheduler import pipe_scheduler, CHANGED
+from pipe_metrics import pipe_metrics, SCAN_BUCKETS
+from grid_proxy import grid_proxy
+from delete_pool import delete_pool, WORKERS, MAX_IOPS
 import json
 
 #---- Gobal defaults ---- Can be overwritten with commandline arguments 
@@ -52,6 +67,34 @@ FTYPE = "daq"
 MRKTYPE = "mrk"
 DONETYPE="done"
 
+MIN_SLEEP = 600   # first sleep after a pass with nothing to remove
+MAX_SLEEP = 3600  # sleep after passes with nothing to remove grows up to this
+HOLD_SLEEP = 360  # sleep while on hold or without proxy
+
+METRICS_PORT = 0  # http port serving metrics, 0 => off
+METRICS_ADDR = "localhost"
+
+#----------------------------------------
+
+def gone_from(names, listing):
+    """ the names that are not in listing; listing is hashed once, names streamed against it """
+    present = set(listing)
+    return [name for name in names if name not in present]
+
+
+def done_in(local_names, remote_done, done):
+    """ the local names whose '<name>.<done>' shows up in remote_done, streamed against the hashed local names """
+    local = set(local_names)
+    suffix = "." + done
+    matched = []
+    for rfile in remote_done:
+        if rfile.endswith(suffix):
+            name = rfile[:-len(suffix)]
+            if name in local:
+                local.discard(name)   # --- each local file once, even if the listing repeats it
+                matched.append(name)
+    return matched
+
 #----------------------------------------
 
 class pipecleaner:
@@ -79,6 +122,23 @@ class pipecleaner:
         self.clean_local_status = args.clean_local_status
         self.clean_local_buffer = args.clean_local_buffer
         self.proc_c = process_commands(args.verbosity)
+        self.scheduler = pipe_scheduler(args.min_sleep, args.max_sleep, self.proc_c)
+        self.scheduler.watch("state", self.trans_status, CHANGED, [self.state_file])
+        self.proxy = grid_proxy(self.proc_c)
+        self.scheduler.watch("proxy", os.path.dirname(self.proxy.path), CHANGED, [os.path.basename(self.proxy.path)])
+        self.status = open_status(args.status_db, self.trans_status, self.proc_c)
+        self.space = None
+        if not args.space_ledger == "None":
+            self.space = space_ledger(self.local_buffer, args.space_ledger, 0, self.proc_c)
+        self.deleter = delete_pool(args.delete_workers, args.max_iops, self.proc_c)
+        self.metrics = pipe_metrics("clean_pipe_", self.proc_c, args.metrics_file)
+        self.metrics.describe("passes_total", "counter", "Cleanup passes run")
+        self.metrics.describe("removed_total", "counter", "Entries removed, by what was cleaned")
+        self.metrics.describe("removed_bytes_total", "counter", "Bytes of data files removed from the local buffer")
+        self.metrics.describe("remove_errors_total", "counter", "Failed removals, by what was cleaned")
+        self.metrics.describe("scan_seconds", "histogram", "Time taken by a remote listing", SCAN_BUCKETS)
+        if args.metrics_port > 0:
+            self.metrics.serve(args.metrics_addr, args.metrics_port)
 
 #------------------------
     def _unixT(self):
@@ -87,8 +147,7 @@ class pipecleaner:
 #-----------------------------------
     def check_proxy(self):
         """ Check for valid proxy, return True/False"""
-        s, _o, _e = self.proc_c.comm("grid-proxy-info -e", shell=True,ignore_dry_run=True)
-        return s == 0
+        return self.proxy.valid()
 
     def check_hold(self):
         """ Check if paused """
@@ -113,29 +172,30 @@ class pipecleaner:
             self.ltime=mtime
 
 
-    def _remote_dirlist(self,rdir):
+    def _remote_dirlist(self,rdir,ltype):
+        """ status and the names ending in ltype of a remote listing, taken from the output as it streams in """
         cmd = "globus-url-copy -list %s" % "/".join([self.remote_url,rdir])
         self.proc_c.log(" Command:: '%s'" % (cmd), 1)
-        s, o, e = self.proc_c.comm(cmd)
-        return s, o
+        flist = []
+        def take(line):
+            for afile in line.split():
+                if afile.endswith(ltype):
+                    flist.append(afile)
+        s, o, e = self.proc_c.comm(cmd, callback=take)
+        self.metrics.observe("scan_seconds", e)
+        return s, flist
 
     def nextRemoteFile(self,rdir,ltype):
-        s, o = self._remote_dirlist(rdir)
+        s, flist = self._remote_dirlist(rdir,ltype)
         if s == 0:
-            flist = o.split()
             for afile in flist:
-                if afile.endswith(ltype):
-                    yield afile
+                yield afile
 
     def getRemoteFileList(self,rdir,ltype):
-        s, o = self._remote_dirlist(rdir)
-        retlist = []
+        s, flist = self._remote_dirlist(rdir,ltype)
         if s == 0:
-            flist = o.split()
-            for afile in flist:
-                if afile.endswith(ltype):
-                    retlist.append(afile)
-        return retlist
+            return flist
+        return []
 
     def nextLocalFile(self,ldir,ltype):
         self.proc_c.log("will search in  %s for %s" % (ldir,ltype),1)
@@ -152,64 +212,60 @@ class pipecleaner:
                     retlist.append(afile)
         return retlist
 
+    def _removed(self, rfile, nbytes):
+        """ book a data file the deleter removed in the space ledger """
+        if self.space is not None:
+            self.space.add(-nbytes, rfile)
+
     def go(self):
 
         while True:
             if not self.check_proxy():
                 self.proc_c.log("No valid proxy at Time=%s" % datetime.now(),0)
-                time.sleep(360)
+                self.scheduler.sleep(HOLD_SLEEP, ["proxy"])
                 continue
             self.notify()
             if self.held:
                 self.proc_c.log("Found Hold Request, will sleep and check again",0)
-                time.sleep(360)
+                self.scheduler.sleep(HOLD_SLEEP, ["state"])
                 continue
+            removed = 0
 
 # clean local status, removes files if remote target file IS NOT in remote transfer dir
             if self.clean_local_status:
-                icount=0
-                ifailed=0
                 self.proc_c.log("getting remote file list from %s" % (self.remote_dir),1)
                 remote_list = self.getRemoteFileList(self.remote_dir,self.ftype)
-                for tfile in self.nextLocalFile(self.trans_status,self.done):
-                    ifound = False
-                    for rfile in remote_list:
-                        if tfile == ".".join([rfile,self.done]):
-                            self.proc_c.log("File still in remote buffer %s" % (rfile), 3)
-                            ifound=True
-                            break
-                    if not ifound:
-                        try:
-                            icount+=1
-                            self.proc_c.log("removing file # %d  %s" % (icount,tfile),0)
-                            os.remove("/".join([self.trans_status,tfile]))
-                        except:
-                            ifailed+=1
-                            self.proc_c.log("remove failed %s" % (tfile),0)
-                self.proc_c.log("\n ------- \n Removed %d Status Files with %d OS errors \n ------- \n" % (icount,ifailed),0)
+                t0 = time.time()
+                for tfile in gone_from(self.status.done_names(), remote_list):
+                    self.proc_c.log("removing status of %s" % (tfile),1)
+                    self.deleter.call(tfile, self.status.forget)
+                icount, ifailed, nbytes = self.deleter.join()
+                self.proc_c.log("\n ------- \n Removed %d Status Files with %d OS errors in %.1f secs \n ------- \n" % 
+                                (icount,ifailed,time.time()-t0),0)
+                self.metrics.inc("removed_total", icount, dict(kind="status"))
+                self.metrics.inc("remove_errors_total", ifailed, dict(kind="status"))
+                removed += icount
 
 
 # clean local buffer, removes files if remote done file IS found in remote status dir
             if self.clean_local_buffer:
-                icount=0
-                ifailed=0
                 local_list = self.getLocalFileList(self.local_buffer,self.ftype)
-                for tfile in self.nextRemoteFile(self.remote_status,self.done):
-                    for rfile in local_list:
-                        if tfile == ".".join([rfile, self.done]):
-                            try:
-                                remove_file="/".join([self.local_buffer,rfile])
-                                remove_mfile=".".join([remove_file,self.mtype])
-                                self.proc_c.log("Will remove files %s and %s" % (remove_file,remove_mfile),1)
-                                os.remove(remove_file)
-                                os.remove(remove_mfile)
-                                icount+=1
-                            except:
-                                ifailed+=1
-                                self.proc_c.log("remove failed %s" % (rfile),0)
-                            break
-                self.proc_c.log("\n ------- \n Removed %d Transfer Files with %d OS errors \n ------- \n" % (icount,ifailed),0)
-            time.sleep(3600)
+                t0 = time.time()
+                for rfile in done_in(local_list, self.nextRemoteFile(self.remote_status,self.done), self.done):
+                    remove_file="/".join([self.local_buffer,rfile])
+                    remove_mfile=".".join([remove_file,self.mtype])
+                    self.proc_c.log("Will remove files %s and %s" % (remove_file,remove_mfile),1)
+                    self.deleter.unlink(rfile, [remove_file, remove_mfile], self._removed)
+                icount, ifailed, nbytes = self.deleter.join()
+                self.metrics.inc("removed_bytes_total", nbytes)
+                self.proc_c.log("\n ------- \n Removed %d Transfer Files (%.1f GBs) with %d OS errors in %.1f secs \n ------- \n" % 
+                                (icount,float(nbytes)/(1 << 30),ifailed,time.time()-t0),0)
+                self.metrics.inc("removed_total", icount, dict(kind="buffer"))
+                self.metrics.inc("remove_errors_total", ifailed, dict(kind="buffer"))
+                removed += icount
+            self.metrics.inc("passes_total")
+            self.metrics.export()
+            self.scheduler.sleep(self.scheduler.next_delay(removed > 0), ["state"])
 
 
 def main():
@@ -227,12 +283,21 @@ def main():
     p.add_argument("--file-type",dest="ftype",default=FTYPE,help="file extention of data files to be transfered")
     p.add_argument("--marker-type",dest="mtype",default=MRKTYPE,help="file extention of the marker file to be transfered")
     p.add_argument("--state-file",dest="state_file",default=STATE_FILE,help="file for external triggers: hold ")
+    p.add_argument("--status-db",dest="status_db",default="None",help="sqlite status store used by transfer_pipeline --status-db")
+    p.add_argument("--space-ledger",dest="space_ledger",default="None",help="space journal of --local-buffer to book removals in, refused if it keeps account of another directory")
     p.add_argument("--time-to-notify",dest="time_to_notify",default=TIME_TO_NOTIFY,help="how frequent to email notice")
+    p.add_argument("--metrics-port",dest="metrics_port",default=METRICS_PORT,help="serve prometheus metrics over http on this port, 0 => off [%(default)s]")
+    p.add_argument("--metrics-addr",dest="metrics_addr",default=METRICS_ADDR,help="address the metrics port is bound to [%(default)s]")
+    p.add_argument("--metrics-file",dest="metrics_file",default="None",help="prometheus textfile (for the node_exporter textfile collector) rewritten after each pass")
+    p.add_argument("--delete-workers",dest="delete_workers",default=WORKERS,help="threads removing files in parallel [%(default)s]")
+    p.add_argument("--max-iops",dest="max_iops",default=MAX_IOPS,help="cap on metadata operations (stats and removals) per second, to spare the metadata servers, 0 => no cap [%(default)s]")
     p.add_argument("--email-addr",dest="email_addr",default=EMAIL_ADDR,help="destination for email notices")
 
     p.add_argument("-v", "--verbose", action="count", dest="verbosity", default=0,                                                                                                 help="be verbose about actions, repeatable")
     p.add_argument("--config-file",dest="config_file",default="None",help="override any configs via a json config file")
 
+    p.add_argument("--min-sleep",dest="min_sleep",default=MIN_SLEEP,help="secs to sleep after a pass that found nothing to remove, doubled up to --max-sleep [%(default)s]")
+    p.add_argument("--max-sleep",dest="max_sleep",default=MAX_SLEEP,help="longest sleep, reached by doubling after passes with nothing to remove [%(default)s]")
     p.add_argument("--clean-local-status", action="store_true", dest="clean_local_status", default=False,
                     help="Clean up local status files after remote buffer has been cleaned")
     p.add_argument("--clean-local-buffer", action="store_true", dest="clean_local_buffer", default=False,
@@ -260,6 +325,15 @@ def main():
             p.error(" Could not open or parse the configfile ")
             return -1
 
+    try:
+        args.min_sleep = int(args.min_sleep)
+        args.max_sleep = int(args.max_sleep)
+        args.metrics_port = int(args.metrics_port)
+        args.delete_workers = int(args.delete_workers)
+        args.max_iops = int(args.max_iops)
+    except ValueError:
+        p.error("sleep values, metrics-port, delete-workers and max-iops must be integers")
+
     try:
         pc = pipecleaner(args)
         return(pc.go())
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+Deletion stage of clean_pipe: removals run in a bounded pool of worker threads, so the
+metadata round trips of a parallel filesystem overlap, and are capped at max_iops
+operations per second by a token bucket so the metadata servers are not flooded.
+
+A data file and its MRK file are handed over as one group and removed by the same worker,
+the data file first.  Failures are logged one by one at verbosity 1, the counts of a pass
+are returned by join() for a single summary line.
+"""
+import errno, os, threading, time, Queue
+
+WORKERS = 8    # removal threads
+MAX_IOPS = 0   # metadata operations (stats and removals) per second, 0 => no cap
+QUEUE_PER_WORKER = 64  # groups queued per worker before submitting blocks
+
+
+class rate_limit:
+    """ token bucket handing out rate tokens per second, with up to one second's worth saved up """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.tokens = float(rate)
+        self.last = time.time()
+        self.pause = threading.Event()
+
+    def take(self):
+        """ wait for a token, returns at once without a rate """
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(float(self.rate), self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.pause.wait(wait)
+
+
+class delete_pool:
+    """ worker threads removing file groups or status entries, at most max_iops a second """
+
+    def __init__(self, nworkers, max_iops, proc_c):
+        self.proc_c = proc_c
+        self.limit = rate_limit(max_iops)
+        self.lock = threading.Lock()
+        self.work = Queue.Queue(nworkers * QUEUE_PER_WORKER)
+        self._reset()
+        for i in range(nworkers):
+            t = threading.Thread(target=self._worker, name="delete-%d" % (i))
+            t.daemon = True
+            t.start()
+
+    def _reset(self):
+        self.nremoved = self.nfailed = self.nbytes = 0
+
+    def unlink(self, name, paths, done=None):
+        """
+            remove the files in paths in order; done(name, nbytes) gets the size of the first one.
+            Once the first is removed, the others (its MRK file) may already be gone.
+        """
+        def remove():
+            self.limit.take()   # --- the stat is a metadata operation as well
+            nbytes = os.path.getsize(paths[0])
+            for i, path in enumerate(paths):
+                self.limit.take()
+                try:
+                    os.remove(path)
+                except OSError as oops:
+                    if i == 0 or oops.errno != errno.ENOENT:
+                        raise
+            return nbytes
+        self.work.put((name, remove, done))
+
+    def call(self, name, action, done=None):
+        """ run action(name), e.g. dropping a status entry, as one rate limited operation """
+        def remove():
+            self.limit.take()
+            action(name)
+            return 0
+        self.work.put((name, remove, done))
+
+    def _worker(self):
+        while True:
+            name, remove, done = self.work.get()
+            try:
+                nbytes = remove()
+                with self.lock:
+                    self.nremoved += 1
+                    self.nbytes += nbytes
+                if done is not None:
+                    done(name, nbytes)
+            except Exception as oops:
+                with self.lock:
+                    self.nfailed += 1
+                self.proc_c.log("remove failed %s: %s" % (name, oops), 1)
+            finally:
+                self.work.task_done()
+
+    def join(self):
+        """ wait for the queued removals, returns (removed, failed, bytes) since the last join """
+        self.work.join()
+        with self.lock:
+            counts = (self.nremoved, self.nfailed, self.nbytes)
+            self._reset()
+        return counts
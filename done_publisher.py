@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+Publication of the '.done' markers of transfer_pipeline --copy-done to the remote site.
+
+Finished names are queued and a background thread pushes their markers in one
+globus-url-copy -f session every flush_secs seconds, or as soon as flush_files names are
+waiting.  A failed session is retried with the next flush (copying a marker twice does no
+harm), so data transfers never wait on it.  Names not yet published are kept in a json file,
+written within save_secs of a change and after each flush, and picked up again after a restart.
+"""
+import os, tempfile, threading, time
+from process_commands import load_json, save_json
+
+FLUSH_SECS = 60
+FLUSH_FILES = 200
+TIMEOUT = 600  # secs a publishing session may take
+SAVE_SECS = 5  # secs a queued name may wait before the queue file is written
+
+
+class done_publisher:
+    """ queue of finished names whose done markers still have to reach the remote site """
+
+    def __init__(self, status, remote_done, copy, pending_file, flush_secs, flush_files, proc_c, save_secs=SAVE_SECS):
+        self.status = status
+        self.remote_done = remote_done   # url of the remote directory the markers go to
+        self.copy = copy                 # copy(listfile, timeout) -> (ok, elapsed)
+        self.pending_file = pending_file
+        self.flush_secs = flush_secs
+        self.flush_files = flush_files
+        self.proc_c = proc_c
+        self.save_secs = save_secs
+        self.cond = threading.Condition()
+        self.save_lock = threading.Lock()
+        self.pending = load_json(pending_file, {}).get("pending", [])
+        self.dirty = False
+        self.saved = time.time()
+        t = threading.Thread(target=self._run, name="done-publisher")
+        t.daemon = True
+        t.start()
+
+    def add(self, fname):
+        with self.cond:
+            self.pending.append(fname)
+            self.dirty = True
+            if len(self.pending) >= self.flush_files:
+                self.cond.notify()
+        if time.time() - self.saved >= self.save_secs:
+            self.save()
+
+    def _run(self):
+        last = time.time()
+        failed = False
+        while True:
+            with self.cond:
+                # --- after a failure wait the full interval, however many names are queued
+                while (failed or len(self.pending) < self.flush_files) and time.time() - last < self.flush_secs:
+                    if self.dirty and time.time() - self.saved >= self.save_secs:
+                        break
+                    self.cond.wait(max(0.1, min(self.save_secs, self.flush_secs - (time.time() - last))))
+                due = time.time() - last >= self.flush_secs or (not failed and len(self.pending) >= self.flush_files)
+                names = self.pending[:self.flush_files]
+            if due:
+                last = time.time()
+                failed = False
+                if names:
+                    try:
+                        failed = not self._flush(names)
+                    except Exception as oops:
+                        self.proc_c.log("Publishing done files failed: %s" % (oops), 0)
+                        failed = True
+            # --- after each flush, or when woken to write the names added since the last save
+            self._save_quietly()
+
+    def _flush(self, names):
+        donefiles = []
+        fd, listfile = tempfile.mkstemp(prefix="guc_done.", suffix=".lst")
+        try:
+            with os.fdopen(fd, "w") as flist:
+                for fname in names:
+                    donefile = self.status.done_file(fname)
+                    if donefile is None or not os.path.isfile(donefile):
+                        continue   # --- cleaned up meanwhile, nothing left to publish
+                    donefiles.append(donefile)
+                    flist.write("file://%s %s/%s\n" % (os.path.abspath(donefile), self.remote_done,
+                                                       os.path.basename(donefile)))
+            ok, elapsed = True, 0
+            if donefiles:
+                ok, elapsed = self.copy(listfile, TIMEOUT)
+        finally:
+            os.remove(listfile)
+        if not ok:
+            self.proc_c.log("Publishing %d done files failed, will retry" % (len(names)), 0)
+            return False
+        for donefile in donefiles:
+            self.status.drop_export(donefile)
+        with self.cond:
+            del self.pending[:len(names)]
+            self.dirty = True
+        self.proc_c.log("Published %d done files in %.1f secs" % (len(names), elapsed), 1)
+        return True
+
+    def _save_quietly(self):
+        try:
+            self.save()
+        except (IOError, OSError) as oops:
+            self.proc_c.log("Can't save done publisher queue: %s" % (oops), 0)
+
+    def save(self):
+        with self.save_lock:
+            with self.cond:
+                if not self.dirty:
+                    return
+                state = dict(pending=list(self.pending))
+                self.dirty = False
+                self.saved = time.time()
+            save_json(self.pending_file, state)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+Cached state of the grid proxy used by transfer_pipeline and clean_pipe.
+
+The remaining lifetime is asked of grid-proxy-info -timeleft once and then counted down
+locally.  grid-proxy-info is only run again once the proxy is close to expiry, or when the
+proxy file is replaced (renewed) or removed, which a stat of the file tells cheaply.  A
+renewed proxy is therefore noticed on the next check; watching proxy_path() wakes the
+daemons for it.
+"""
+import os, threading, time
+
+RECHECK = 600  # secs before the cached expiry from which grid-proxy-info is asked again
+REQUERY = 60   # but no more often than this, unless the proxy file changes
+
+
+def proxy_path():
+    """ the proxy file grid tools use: $X509_USER_PROXY or /tmp/x509up_u<uid> """
+    return os.environ.get("X509_USER_PROXY", "/tmp/x509up_u%d" % (os.getuid()))
+
+
+class grid_proxy:
+    """ remaining lifetime of the grid proxy, cached until near expiry or the proxy file changes """
+
+    def __init__(self, proc_c, recheck=RECHECK):
+        self.proc_c = proc_c
+        self.recheck = recheck
+        self.path = proxy_path()
+        self.lock = threading.Lock()
+        self.expires = 0
+        self.queried = 0
+        self.checked = None  # mtime of the proxy file when grid-proxy-info was last run
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def _query(self):
+        s, o, e = self.proc_c.comm("grid-proxy-info -timeleft", ignore_dry_run=True)
+        try:
+            left = int(o.split()[-1]) if s == 0 else 0
+        except (IndexError, ValueError):
+            self.proc_c.log("Can't read proxy lifetime from '%s'" % (o.strip()), 0)
+            left = 0
+        self.queried = time.time()
+        self.expires = self.queried + max(0, left)
+        self.proc_c.log("Proxy %s has %d secs left" % (self.path, left), 1)
+
+    def timeleft(self):
+        """ secs the proxy is still valid for, 0 if there is none """
+        mtime = self._mtime()
+        with self.lock:
+            now = time.time()
+            if mtime is None:
+                self.checked = None
+                self.expires = 0
+            elif mtime != self.checked or (self.expires - now < self.recheck and now - self.queried >= REQUERY):
+                self._query()
+                self.checked = mtime
+            return max(0, int(self.expires - time.time()))
+
+    def valid(self, needed=0):
+        """ True if the proxy outlasts the next needed secs """
+        return self.timeleft() > needed
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Online tuning of the globus-url-copy stream settings (-p, -tcp-bs and, for batch sessions, -cc).
+
+Transfers are split into size classes, each tuned on its own.  Small files always get a single
+stream and the default TCP buffer, there is nothing to gain from more.  For the other classes the
+tuner keeps a moving average of the MB/s measured with every setting tried, uses the best one
+and now and then tries a neighbouring setting (one step up or down in one option, within the
+configured bounds), i.e. a hill climb.  As the averages follow the latest transfers, the tuner
+moves on by itself when the WAN changes.  State is kept in a json file across restarts.
+"""
+import random, threading
+from process_commands import load_json, save_json
+
+MEGABYTES = 1 << 20
+GIGABYTES = 1 << 30
+
+SMALL_FILE = 100 * MEGABYTES   # below: "small", single stream
+LARGE_FILE = 2 * GIGABYTES     # from here: "large"
+EXPLORE = 0.15                 # chance of trying a neighbouring setting
+SMOOTHING = 0.3                # weight of the newest rate in a setting's moving average
+DEFAULT_BS = "0"               # tcp-bs choice meaning 'leave globus-url-copy's default'
+
+
+def _powers_of_two(maximum):
+    choices = [1]
+    while choices[-1] * 2 <= maximum:
+        choices.append(choices[-1] * 2)
+    return choices
+
+
+def _nearest(choices, value):
+    return min(choices, key=lambda c: abs(c - value))
+
+
+class guc_tuner:
+    """ picks and learns globus-url-copy settings per size class """
+
+    def __init__(self, tuner_file, parallel, parallel_max, tcp_bs_choices, concurrency, concurrency_max, proc_c):
+        self.tuner_file = tuner_file
+        self.proc_c = proc_c
+        self.lock = threading.Lock()
+        self.p_choices = _powers_of_two(parallel_max)
+        self.bs_choices = tcp_bs_choices
+        self.cc_choices = _powers_of_two(concurrency_max)
+        self.start = [_nearest(self.p_choices, parallel), self.bs_choices[0],
+                      _nearest(self.cc_choices, concurrency)]
+        self.classes = load_json(tuner_file, {}).get("classes", {})  # class -> setting key -> [MB/s, count]
+        self.dirty = False
+
+    def size_class(self, nbytes, batch=False):
+        if batch:
+            return "batch"
+        if nbytes is None or nbytes < SMALL_FILE:
+            return "small"
+        if nbytes < LARGE_FILE:
+            return "medium"
+        return "large"
+
+    def _key(self, setting):
+        return "/".join([str(x) for x in setting])
+
+    def _setting(self, key):
+        p, bs, cc = key.split("/")
+        return [int(p), bs, int(cc)]
+
+    def _neighbours(self, cls, setting):
+        dims = [(0, self.p_choices), (1, self.bs_choices)]
+        if cls == "batch":
+            dims.append((2, self.cc_choices))
+        neighbours = []
+        for i, choices in dims:
+            if setting[i] not in choices:
+                continue
+            j = choices.index(setting[i])
+            for k in (j - 1, j + 1):
+                if 0 <= k < len(choices):
+                    neighbour = list(setting)
+                    neighbour[i] = choices[k]
+                    neighbours.append(neighbour)
+        return neighbours
+
+    def choose(self, nbytes, batch=False):
+        """ (size class, [parallel, tcp-bs, concurrency]) to use for a transfer of nbytes """
+        cls = self.size_class(nbytes, batch)
+        if cls == "small":
+            return cls, [1, DEFAULT_BS, 1]
+        with self.lock:
+            arms = self.classes.get(cls, {})
+            if arms:
+                best = self._setting(max(arms, key=lambda key: arms[key][0]))
+            else:
+                best = list(self.start)
+        if cls != "batch":
+            best[2] = 1
+        neighbours = self._neighbours(cls, best)
+        if neighbours and random.random() < EXPLORE:
+            best = random.choice(neighbours)
+            self.proc_c.log("Tuner trying %s for %s files" % (self._key(best), cls), 2)
+        return cls, best
+
+    def record(self, choice, nbytes, elapsed):
+        """ fold the rate of a finished transfer into the average of the setting it used """
+        cls, setting = choice
+        if cls == "small" or not nbytes or elapsed <= 0:
+            return
+        rate = float(nbytes) / MEGABYTES / elapsed
+        key = self._key(setting)
+        with self.lock:
+            arm = self.classes.setdefault(cls, {}).setdefault(key, [rate, 0])
+            arm[0] += SMOOTHING * (rate - arm[0])
+            arm[1] += 1
+            self.dirty = True
+        self.proc_c.log("Tuner: %s files with %s at %.2f MB/sec" % (cls, key, rate), 2)
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self.lock:
+            state = dict(classes=dict((cls, dict((key, list(arm)) for key, arm in arms.items()))
+                                      for cls, arms in self.classes.items()))
+            self.dirty = False
+        save_json(self.tuner_file, state)
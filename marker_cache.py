@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Local cache of the MRK files of transfer_pipeline.
+
+The MRK files of the files found by a listing are copied into the cache directory in one
+globus-url-copy session and their sizes kept in memory, so files are sized before any data
+moves and a transfer only has to move its MRK file next to the target file.
+"""
+import os, shutil, threading, time
+
+KEEP = 86400  # secs an unused MRK file stays in the cache
+
+
+class marker_cache:
+    """ MRK files fetched ahead of their transfer, and the sizes they give """
+
+    def __init__(self, cache_dir, mtype, proc_c):
+        self.cache_dir = cache_dir
+        self.mtype = mtype
+        self.proc_c = proc_c
+        self.lock = threading.Lock()
+        self.sizes = {}   # name -> expected size in bytes, None if the MRK file can't be read
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, tfile):
+        return "/".join([self.cache_dir, ".".join([tfile, self.mtype])])
+
+    def has(self, tfile):
+        return os.path.isfile(self.path(tfile))
+
+    def _parse(self, tfile):
+        try:
+            with open(self.path(tfile)) as mfile:
+                return int(mfile.readline().split(" ")[0])*1024
+        except (IOError, ValueError):
+            return None
+
+    def load(self, tfiles):
+        """ read the sizes of the cached MRK files of tfiles, returns how many were there """
+        nloaded = 0
+        for tfile in tfiles:
+            if not self.has(tfile):
+                continue
+            size = self._parse(tfile)
+            with self.lock:
+                self.sizes[tfile] = size
+            nloaded += 1
+        return nloaded
+
+    def size(self, tfile):
+        """ expected size of tfile in bytes, None when not known """
+        with self.lock:
+            if tfile in self.sizes:
+                return self.sizes[tfile]
+        if self.has(tfile):
+            self.load([tfile])
+            return self.sizes.get(tfile)
+        return None
+
+    def take(self, tfile, dest):
+        """ move the cached MRK file of tfile to dest, False if it is not cached """
+        if not self.has(tfile):
+            return False
+        try:
+            self.size(tfile)
+            shutil.move(self.path(tfile), dest)
+        except (IOError, OSError) as oops:
+            self.proc_c.log("Can't take cached marker of %s: %s" % (tfile, oops), 0)
+            return False
+        return True
+
+    def forget(self, tfile):
+        with self.lock:
+            self.sizes.pop(tfile, None)
+
+    def prune(self, keep=KEEP):
+        """ drop MRK files nobody took for keep secs, e.g. of files moved by another node """
+        cutoff = time.time() - keep
+        nremoved = 0
+        for name in os.listdir(self.cache_dir):
+            path = "/".join([self.cache_dir, name])
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    nremoved += 1
+            except OSError:
+                continue
+        if nremoved:
+            self.proc_c.log("Pruned %d unused cached marker files" % (nremoved), 1)
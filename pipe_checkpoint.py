@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Checkpoint of the work transfer_pipeline has in hand: the files found ready but not yet
+transferred (pending) and the files claimed and being transferred (in flight), with the lease
+owner they were claimed as, and the process groups of the copy commands running for them.
+These are written as soon as they change, so even after a kill -9 the copies left running
+can be stopped and the leases taken over straight away.  The pending files, which can be
+many, go to a second file ('.pending') written every interval secs while they change and at the
+end of each pass.  After a restart the in-flight files are settled against what is on
+disk and the pending ones transferred before the remote buffer is listed again.
+"""
+import threading, time
+from process_commands import load_json, save_json
+
+INTERVAL = 30  # secs between writes of the pending files while they come and go
+
+
+class pipe_checkpoint:
+    """ pending and in-flight file names, saved to json files """
+
+    def __init__(self, checkpoint_file, owner, proc_c, interval=INTERVAL):
+        self.checkpoint_file = checkpoint_file
+        self.pending_file = checkpoint_file + ".pending"
+        self.owner = owner
+        self.proc_c = proc_c
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        state = load_json(checkpoint_file, {})
+        pending = load_json(self.pending_file, {}).get("pending", [])
+        owner = state.get("owner")
+        self.previous = (owner and str(owner), [str(fname) for fname in pending],
+                         [str(fname) for fname in state.get("inflight", [])],
+                         dict((str(pgid), str(command)) for pgid, command in state.get("commands", {}).items()))
+        self.pending = set()
+        self.inflight = set()
+        self.commands = {}   # process group id -> command running in it
+        self.saved = time.time()
+        self.dirty = True
+        self.pending_dirty = True
+
+    def restored(self):
+        """ (lease owner, pending names, in-flight names, {process group: command}) of the checkpoint found at startup """
+        return self.previous
+
+    def queued(self, fnames):
+        with self.lock:
+            self.pending.update(fnames)
+            self.pending_dirty = True
+        self._maybe_save()
+
+    def started(self, fname):
+        with self.lock:
+            self.pending.discard(fname)
+            self.inflight.add(fname)
+            self.dirty = self.pending_dirty = True
+        self._maybe_save()
+
+    def finished(self, fname):
+        with self.lock:
+            self.pending.discard(fname)
+            self.pending_dirty = True
+            if fname in self.inflight:
+                self.inflight.discard(fname)
+                self.dirty = True
+        self._maybe_save()
+
+    def running(self, pgid, command):
+        with self.lock:
+            self.commands[str(pgid)] = command
+            self.dirty = True
+        self._maybe_save()
+
+    def exited(self, pgid):
+        with self.lock:
+            self.commands.pop(str(pgid), None)
+            self.dirty = True
+        self._maybe_save()
+
+    def running_commands(self):
+        """ (process group, command) of the commands running now """
+        with self.lock:
+            return [(int(pgid), command) for pgid, command in self.commands.items()]
+
+    def _maybe_save(self):
+        """ in-flight changes at once, the pending files every interval secs """
+        self.save(time.time() - self.saved >= self.interval)
+
+    def save(self, with_pending=True):
+        with self.save_lock:
+            with self.lock:
+                state = pending = None
+                if self.dirty:
+                    state = dict(owner=self.owner, inflight=sorted(self.inflight), commands=dict(self.commands))
+                    self.dirty = False
+                if with_pending and self.pending_dirty:
+                    pending = dict(pending=sorted(self.pending))
+                    self.pending_dirty = False
+                    self.saved = time.time()
+            if state is not None:
+                save_json(self.checkpoint_file, state)
+            if pending is not None:
+                save_json(self.pending_file, pending)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+Cumulative counters, gauges and histograms of transfer_pipeline and clean_pipe, rendered in
+the Prometheus text format.  They are served on a local HTTP endpoint and/or written to a
+textfile for node_exporter's textfile collector after every pass.
+"""
+import os, threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+SECONDS_BUCKETS = [1, 5, 15, 60, 300, 900, 3600, 14400]
+RATE_BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000]
+SCAN_BUCKETS = [0.5, 1, 5, 15, 60, 300, 900]
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % (",".join(['%s="%s"' % (k, v) for k, v in sorted(labels.items())]))
+
+
+class pipe_metrics:
+    """ named metrics of one daemon, safe to update from the transfer workers """
+
+    def __init__(self, prefix, proc_c, textfile="None"):
+        self.prefix = prefix
+        self.proc_c = proc_c
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.kinds = {}     # name -> (type, help, buckets)
+        self.values = {}    # name -> {label string: value or [bucket counts, sum, count]}
+        self.server = None
+
+    def describe(self, name, mtype, help, buckets=None):
+        """ declare a counter, gauge or histogram """
+        self.kinds[name] = (mtype, help, buckets)
+        self.values[name] = {}
+
+    def inc(self, name, value=1, labels=None):
+        key = _labels(labels)
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.values[name][_labels(labels)] = value
+
+    def observe(self, name, value, labels=None):
+        buckets = self.kinds[name][2]
+        key = _labels(labels)
+        with self.lock:
+            series = self.values[name]
+            if key not in series:
+                series[key] = [[0] * len(buckets), 0.0, 0]
+            counts, total, n = series[key]
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    counts[i] += 1
+            series[key] = [counts, total + value, n + 1]
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.kinds):
+                mtype, help, buckets = self.kinds[name]
+                full = self.prefix + name
+                lines.append("# HELP %s %s" % (full, help))
+                lines.append("# TYPE %s %s" % (full, mtype))
+                for key, value in sorted(self.values[name].items()):
+                    if mtype != "histogram":
+                        lines.append("%s%s %s" % (full, key, value))
+                        continue
+                    counts, total, n = value
+                    inner = key[1:-1]
+                    for le, count in zip(buckets, counts):
+                        le_labels = ",".join([x for x in [inner, 'le="%s"' % (le)] if x])
+                        lines.append("%s_bucket{%s} %d" % (full, le_labels, count))
+                    le_labels = ",".join([x for x in [inner, 'le="+Inf"'] if x])
+                    lines.append("%s_bucket{%s} %d" % (full, le_labels, n))
+                    lines.append("%s_sum%s %s" % (full, key, total))
+                    lines.append("%s_count%s %d" % (full, key, n))
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """ write the node_exporter textfile, if any, replaced atomically so it is never read half written """
+        if self.textfile == "None":
+            return
+        tmpfile = "%s.tmp" % (self.textfile)
+        try:
+            with open(tmpfile, "w") as mfile:
+                mfile.write(self.render())
+            os.rename(tmpfile, self.textfile)
+        except (IOError, OSError) as oops:
+            self.proc_c.log("Can't write metrics file %s: %s" % (self.textfile, oops), 0)
+
+    def serve(self, addr, port):
+        """ serve the metrics on http://addr:port/metrics from a background thread """
+        metrics = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                metrics.proc_c.log("metrics: " + fmt % args, 3)
+
+        self.server = HTTPServer((addr, port), handler)
+        t = threading.Thread(target=self.server.serve_forever, name="metrics")
+        t.daemon = True
+        t.start()
+        self.proc_c.log("Serving metrics on %s:%d" % (addr, port), 1)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+Scheduling of the passes of transfer_pipeline and clean_pipe.
+
+Instead of a fixed sleep after every pass, the next delay depends on what the pass found:
+no delay while there is work left, a delay growing from min_sleep to max_sleep while there
+is nothing to do.  Sleeps can be cut short by file system events on watched directories,
+e.g. the state file changing or files being removed from the buffer.  Events come from
+inotify where it is available (Linux); as inotify only reports changes made on this node,
+watched file names are also polled for a new mtime every poll_interval seconds.
+"""
+import ctypes, ctypes.util, errno, os, select, struct, time
+
+POLL_INTERVAL = 30
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+CHANGED = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+REMOVED = IN_DELETE | IN_MOVED_FROM
+
+_EVENT = struct.Struct("iIII")
+
+
+class _inotify:
+    """ minimal ctypes binding of the Linux inotify calls """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed on %s" % (path))
+        return wd
+
+    def read_events(self):
+        """ (watch descriptor, mask, name) of the events queued so far """
+        data = os.read(self.fd, 65536)
+        events = []
+        i = 0
+        while i + _EVENT.size <= len(data):
+            wd, mask, cookie, nlen = _EVENT.unpack_from(data, i)
+            i += _EVENT.size
+            name = data[i:i + nlen].rstrip("\0")
+            i += nlen
+            events.append((wd, mask, name))
+        return events
+
+
+class pipe_scheduler:
+    """ works out the sleep between passes and waits on the watched paths """
+
+    def __init__(self, min_sleep, max_sleep, proc_c, poll_interval=POLL_INTERVAL):
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.poll_interval = poll_interval
+        self.proc_c = proc_c
+        self.delay = min_sleep
+        self.stopping = False
+        self.watches = {}     # group -> list of (watch descriptor, mask, names)
+        self.polled = {}      # group -> list of files whose mtime is polled
+        try:
+            self.inotify = _inotify()
+        except (OSError, AttributeError) as oops:
+            self.proc_c.log("No inotify, will only poll watched files: %s" % (oops), 1)
+            self.inotify = None
+
+    def watch(self, group, path, mask, names=None):
+        """
+            wake sleeps waiting on group when an event in mask happens in directory path,
+            restricted to the files in names if given (those are polled as well)
+        """
+        if names:
+            self.polled.setdefault(group, []).extend(["/".join([path, name]) for name in names])
+        if self.inotify is None:
+            return
+        try:
+            wd = self.inotify.add_watch(path, mask)
+        except OSError as oops:
+            self.proc_c.log("Can't watch %s: %s" % (path, oops), 0)
+            return
+        self.watches.setdefault(group, []).append((wd, mask, names))
+
+    def stop(self):
+        """ end the current and any further sleep, e.g. from a signal handler """
+        self.stopping = True
+
+    def next_delay(self, busy):
+        """
+            delay before the next pass: none while the last pass found work,
+            doubling from min_sleep up to max_sleep while it did not
+        """
+        if busy:
+            self.delay = self.min_sleep
+            return 0
+        delay = self.delay
+        self.delay = min(self.max_sleep, self.delay * 2)
+        return delay
+
+    def _mtimes(self, groups):
+        mtimes = {}
+        for group in groups:
+            for path in self.polled.get(group, []):
+                try:
+                    mtimes[path] = os.stat(path).st_mtime
+                except OSError:
+                    mtimes[path] = None
+        return mtimes
+
+    def _woken(self, groups):
+        """ True if any queued inotify event belongs to one of groups """
+        for wd, mask, name in self.inotify.read_events():
+            for group in groups:
+                for gwd, gmask, names in self.watches.get(group, []):
+                    if wd == gwd and mask & gmask and (not names or name in names):
+                        self.proc_c.log("Woken by %s on '%s'" % (group, name), 2)
+                        return True
+        return False
+
+    def sleep(self, seconds, groups=()):
+        """ sleep up to seconds, returning early on an event for one of the watch groups """
+        if seconds <= 0:
+            return
+        self.proc_c.log("Sleeping up to %d secs" % (seconds), 1)
+        mtimes = self._mtimes(groups)
+        end = time.time() + seconds
+        while not self.stopping:
+            left = end - time.time()
+            if left <= 0:
+                return
+            wait = min(left, self.poll_interval)
+            if self.inotify is None:
+                time.sleep(wait)
+            else:
+                try:
+                    readable = select.select([self.inotify.fd], [], [], wait)[0]
+                except select.error as oops:
+                    if oops.args[0] != errno.EINTR:
+                        raise
+                    readable = []
+                if readable and self._woken(groups):
+                    return
+            if self._mtimes(groups) != mtimes:
+                self.proc_c.log("Woken by a change of %s" % (", ".join(groups)), 2)
+                return
@@ -3,13 +3,22 @@
 """
 Set of routines that are used to run and kill a shell command as needed
 """
-import math, os, pprint, re, shlex, shutil, socket, stat, time
+import errno, math, os, pprint, re, shlex, shutil, socket, stat, threading, time
+from collections import deque
 from datetime import datetime
-from signal import alarm, signal, SIGALRM, SIGKILL, SIGTERM
+from signal import SIGKILL, SIGTERM
 from subprocess import Popen, PIPE, STDOUT
 import smtplib
 from email.mime.text import MIMEText
 import getpass
+import json
+
+KILL_GRACE = 5  # secs between sigterm and sigkill of a timed out command
+TAIL_LINES = 200  # lines of output kept when streaming it to a callback
+WATCH_INTERVAL = 1  # secs between calls of a command's watchdog
+READ_SIZE = 4096  # bytes per read of a streamed command's output
+MAX_LINE = 65536  # longest line handed to a callback, longer ones are cut
+LINE_END = re.compile(r"\r\n|\r|\n")  # globus-url-copy -vb redraws its performance line with '\r'
 
 class commException(Exception):
     def __init__(self, command, status, output):
@@ -20,6 +29,20 @@ class commException(Exception):
         return "Command failed: '%s' with status '%s'" % (self.command,
                                                           self.status)
 
+def load_json(path, default):
+    """ read a json state file, returning default when it does not exist yet """
+    if not os.path.isfile(path):
+        return default
+    with open(path) as jfile:
+        return json.load(jfile)
+
+def save_json(path, obj):
+    """ write a json state file via a rename so readers never see it half written """
+    tmpfile = "%s.%s.%d.tmp" % (path, socket.gethostname(), os.getpid())
+    with open(tmpfile, "w") as jfile:
+        json.dump(obj, jfile)
+    os.rename(tmpfile, path)
+
 class process_commands:
     """ class to support process management """
     def __init__(self,verbosity):
@@ -40,75 +63,144 @@ class process_commands:
             pprint.pprint(msg, depth=6)
 
 
-    def _get_process_progeny(self, pid):
+    def _signal_group(self, pgid, sig):
+        try:
+            os.killpg(pgid, sig)
+        except OSError as ose:
+            if ose.errno != errno.ESRCH:
+                self.log("Ignoring error signalling group %d: %s" %
+                         (pgid, ose), 2)
 
-        """ A helper funciton for _kill_progeny to try and find all
-        child processes spawned (and children of children, etc.) of a
-        given pid.  Note: this will miss orphaned children, perhaps
-        there is a way to use session ids to track them... """
-        
-        pscmd = "ps -o pid,ppid "
-        if sys.platform.lower().startswith("linux"):
-            pscmd += "x"  # Linux is so "special"
-        else:
-            pscmd += "-x"
-
-        p = Popen(shlex.split(pscmd), stdout=PIPE, stderr=STDOUT)
-        psout = p.communicate()[0]
-        ps_lines = psout.splitlines()[1:]
-        ps_list = [map(int, l.split()) for l in ps_lines]
-        progeny = [pid]
-        xdone = False
-        while not xdone:
-            found = False
-            for pid, ppid in ps_list[:]:
-                if ppid in progeny:
-                    progeny.append(pid)
-                    ps_list.remove([pid, ppid])
-                    found = True
-            xdone = not found
-        return progeny
-
-
-    def _kill_progeny(self, proc):
-
-        """ Send a term, then a kill signal to the process and any
-        child processes that can be found. """
+
+    def _group_alive(self, pgid):
+        try:
+            os.killpg(pgid, 0)
+        except OSError as ose:
+            return ose.errno == errno.EPERM
+        return True
+
+
+    def _runs(self, pid, command):
+        """ True if process pid runs command, also when there is no
+        /proc to tell """
+        try:
+            with open("/proc/%d/cmdline" % (pid)) as cfile:
+                return command in cfile.read()
+        except IOError:
+            return not os.path.isdir("/proc")
+
+
+    def kill_group(self, pgid, command=None, grace=KILL_GRACE):
+
+        """ Send a term, then a kill signal to process group pgid, e.g.
+        one an earlier instance left running, and wait for it to go.
+        If command is given, the group is only signalled while its
+        leader still runs command, so a recycled pid is left alone.
+        Returns True once no process of the group is left. """
+
+        if command is not None and not self._runs(pgid, command):
+            return not self._group_alive(pgid)
+        pause = threading.Event()
+        for sig in (SIGTERM, SIGKILL):
+            self.log("sending signal %d to process group: %d" % (sig, pgid), 1)
+            self._signal_group(pgid, sig)
+            t_end = time.time() + grace
+            while self._group_alive(pgid) and time.time() < t_end:
+                pause.wait(0.1)
+            if not self._group_alive(pgid):
+                return True
+        return False
+
+
+    def _kill_progeny(self, proc, reader):
+
+        """ Send a term, then a kill signal to the process group of
+        proc.  The command runs in its own session, so the group holds
+        every child it has spawned, including orphaned ones.  The
+        grace period ends as soon as the group has closed its output
+        and proc has exited (i.e. reader is done). """
 
         # Try a sigterm
-        pids = self._get_process_progeny(proc.pid)
-        self.log("terminating pids: %s" % pids, 2)
-        for pid in pids:
-            try:
-                os.kill(pid, SIGTERM)
-            except OSError as ose:
-                self.log("Ignoring error terminating pid %d: %s" %
-                         (pid, ose), 2)
-        time.sleep(5)
-
-        # no more mr nice-guy
-        self.log("killing pids: %s" % pids, 2)
-        for pid in pids:
+        self.log("terminating process group: %d" % proc.pid, 2)
+        self._signal_group(proc.pid, SIGTERM)
+        reader.join(KILL_GRACE)
+
+        # no more mr nice-guy, also for anything the leader left behind
+        self.log("killing process group: %d" % proc.pid, 2)
+        self._signal_group(proc.pid, SIGKILL)
+        reader.join()
+
+    def _stream_output(self, proc, callback):
+
+        """ Hand each line of proc's output to callback as soon as
+        it is complete, keeping only a bounded tail of it for error
+        reporting.  The output is read in chunks and lines end with a
+        newline or a carriage return, so progress lines redrawn in
+        place arrive one by one while the command runs. """
+
+        tail = deque(maxlen=TAIL_LINES)
+        def take(line):
+            tail.append(line)
             try:
-                os.kill(pid, SIGKILL)
-            except OSError as ose:
-                self.log("Ignoring error killing pid %d: %s" %
-                         (pid, ose), 2)
+                callback(line)
+            except Exception as oops:
+                self.log("Ignoring error in output callback: %s" % (oops), 0)
+
+        pending = ""
+        fd = proc.stdout.fileno()
+        for chunk in iter(lambda: os.read(fd, READ_SIZE), ""):
+            pending += chunk
+            start = 0
+            for end in LINE_END.finditer(pending):
+                take(pending[start:end.end()])
+                start = end.end()
+            pending = pending[start:]
+            while len(pending) > MAX_LINE:
+                take(pending[:MAX_LINE])
+                pending = pending[MAX_LINE:]
+        if pending:
+            take(pending)
+        proc.stdout.close()
+        return "".join(tail)
+
+    def _wait_reader(self, cmd, proc, reader, t0, timeout, watchdog):
+
+        """ Wait for the command to finish, killing it when the
+        timeout is exceeded or the watchdog asks for it. """
 
-        # These should now not block and possibly return something
-        # informative
-        output = proc.communicate()[0]
-        status = proc.wait()
-        return status, output        
+        while True:
+            wait = WATCH_INTERVAL
+            if timeout > 0:
+                wait = min(wait, t0 + timeout - time.time())
+            reader.join(max(wait, 0))
+            if not reader.is_alive():
+                return
+            # Clean up, if timeout exceeded or stopped by the watchdog.
+            if timeout > 0 and time.time() - t0 >= timeout:
+                self.log("timeout exceeded on %s" % (cmd), 1)
+                break
+            if watchdog is not None and watchdog():
+                self.log("watchdog stopped %s" % (cmd), 1)
+                break
+        self._kill_progeny(proc, reader)
 
-    def comm(self, cmd, shell=False, timeout=0, ignore_dry_run=False):
+    def comm(self, cmd, shell=False, timeout=0, ignore_dry_run=False, callback=None, watchdog=None,
+             started=None):
 
         """ Run given command, honoring option.dry_run value (unless
         ignore_dry_run is True), returning status, output (combined
-        stdout/err as a single string) and elapsed time.  If timeout
-        is non-zero, then a sigalarm will be used to interrupt the
-        command and the command and all child processes it has spawned
-        will be sent sigterm & possibly sigkill signals. """
+        stdout/err as a single string) and elapsed time.  The command
+        runs in its own session; if timeout is non-zero and exceeded,
+        its whole process group will be sent sigterm & possibly sigkill
+        signals.  Does not use signals itself, so it can be called from
+        any thread, and waits with timeouts, so the signal handlers of
+        the main thread run while it waits.  If a callback is given, it is called with each
+        line of output as it arrives and only the last TAIL_LINES lines
+        are kept and returned as output.  A watchdog, if given, is
+        called every WATCH_INTERVAL secs while the command runs and
+        the command is killed as soon as it returns True.  If started
+        is given, it is called with the pid of the command, which is
+        also the id of its process group, as soon as it runs. """
 
         if not ignore_dry_run and self.dry_run:
             self.log("dry-run: '%s' timeout=%d" % (cmd, timeout), 0)
@@ -121,36 +213,32 @@ class process_commands:
         else:
             cmd_arg = shlex.split(cmd)
 
-        # timeout exception and handler
-        class Alarm(Exception):
-            pass
-
-        def alarm_handler(signum, frame):
-            raise Alarm
-
-        if timeout > 0:
-            signal(SIGALRM, alarm_handler)
-            alarm(timeout)
-
-        proc_tobe_killed = None
         t0 = time.time()
         try:
-            proc = Popen(cmd_arg, shell=shell, stdout=PIPE, stderr=STDOUT)
-            output = proc.communicate()[0]
-            status = proc.wait()
-            if timeout > 0:
-                alarm(0) # clear alarm
+            proc = Popen(cmd_arg, shell=shell, stdout=PIPE, stderr=STDOUT,
+                         close_fds=True, preexec_fn=os.setsid)
         except OSError:
             self.log("Error running: %s" % cmd, 0)
             raise
-        except Alarm:
-            self.log("timeout exceeded on %s" % (cmd), 1)
-            proc_tobe_killed = proc
-
-        # Clean up, if timeout exceeded.
-        if proc_tobe_killed is not None:
-            status, output = self._kill_progeny(proc_tobe_killed)
-        
+        if started is not None:
+            started(proc.pid)
+
+        result = []
+        def read_output():
+            if callback is None:
+                output = proc.communicate()[0]
+            else:
+                output = self._stream_output(proc, callback)
+            result.append((proc.wait(), output))
+
+        # --- waiting on the reader with timeouts also lets signal
+        # --- handlers run while a long command blocks in a read
+        reader = threading.Thread(target=read_output)
+        reader.daemon = True
+        reader.start()
+        self._wait_reader(cmd, proc, reader, t0, timeout, watchdog)
+        status, output = result[0]
+
         elapsed = time.time() - t0
         self.log("status: %d" % (status), 3)
         self.log("output: %s" % output, 3)
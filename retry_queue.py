@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+Failure history of the files transfer_pipeline could not move, kept in a json file.
+
+Each failing file gets a failure count, its last error (mrk, copy, validation or checksum) and the time
+it may be tried again, backing off exponentially from base_delay up to max_delay.  A file that
+has failed max_failures times is quarantined and no longer tried until an operator takes it
+out of the file.  A file that transfers is dropped from the queue.
+
+Run as:  retry_queue.py retry_file     to list the quarantined and failing files
+"""
+import sys, threading, time
+from process_commands import load_json, save_json
+
+BASE_DELAY = 300
+MAX_DELAY = 86400
+MAX_FAILURES = 10  # 0 => never quarantine
+
+
+class retry_queue:
+    """ per file failure count, last error and next eligible time """
+
+    def __init__(self, queue_file, base_delay, max_delay, max_failures, proc_c):
+        self.queue_file = queue_file
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_failures = max_failures
+        self.proc_c = proc_c
+        self.lock = threading.Lock()
+        self.files = load_json(queue_file, {}).get("files", {})
+        self.dirty = False
+
+    def failed(self, fname, error):
+        """ count a failure of fname and work out when it may be tried again """
+        now = int(time.time())
+        with self.lock:
+            entry = self.files.setdefault(fname, dict(failures=0, first=now))
+            entry["failures"] += 1
+            entry["error"] = error
+            entry["last"] = now
+            entry["next"] = now + min(self.max_delay, self.base_delay * 2 ** (entry["failures"] - 1))
+            entry["quarantined"] = self.max_failures > 0 and entry["failures"] >= self.max_failures
+            self.dirty = True
+        if entry["quarantined"]:
+            self.proc_c.log("Quarantined %s after %d failures, last error: %s" % (fname, entry["failures"], error), 0)
+        else:
+            self.proc_c.log("%s failed (%s) %d times, next try in %d secs" %
+                            (fname, error, entry["failures"], entry["next"] - now), 1)
+
+    def succeeded(self, fname):
+        with self.lock:
+            if self.files.pop(fname, None) is not None:
+                self.dirty = True
+
+    def eligible(self, fname):
+        """ True if fname is not quarantined nor backing off """
+        with self.lock:
+            entry = self.files.get(fname)
+        return entry is None or (not entry["quarantined"] and entry["next"] <= time.time())
+
+    def quarantined(self, fname):
+        with self.lock:
+            entry = self.files.get(fname)
+        return entry is not None and entry["quarantined"]
+
+    def summary(self):
+        """ (number of files backing off, number quarantined) """
+        with self.lock:
+            nquarantined = len([e for e in self.files.values() if e["quarantined"]])
+        return len(self.files) - nquarantined, nquarantined
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self.lock:
+            state = dict(files=dict((fname, dict(entry)) for fname, entry in self.files.items()))
+            self.dirty = False
+        save_json(self.queue_file, state)
+
+
+def report(files):
+    """ lines listing the quarantined files, then the others by failure count """
+    lines = []
+    order = sorted(files.items(), key=lambda fe: (not fe[1]["quarantined"], -fe[1]["failures"], fe[0]))
+    for fname, entry in order:
+        lines.append("%-12s %4d failures  last error %-10s  last %s  %s" %
+                     (entry["quarantined"] and "QUARANTINED" or "backing off", entry["failures"], entry["error"],
+                      time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last"])), fname))
+    return lines
+
+
+def main():
+    if len(sys.argv) != 2:
+        print "Run as:  retry_queue.py retry_file"
+        return 1
+    for line in report(load_json(sys.argv[1], {}).get("files", {})):
+        print line
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
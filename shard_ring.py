@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+Consistent-hash sharding of the remote buffer between several transfer_pipeline instances.
+
+Every instance has a node id and writes a heartbeat file of that name into a members directory
+on the shared status filesystem.  The live members (those of the configured list, or all
+members when no list is given, whose heartbeat is younger than ttl) are placed on a hash
+ring with vnodes points each, and an instance only moves the files that hash to it.  When a
+member's heartbeat stops, the ring is rebuilt without it and its files spread over the others;
+as only that member's share moves, the others keep their files.
+"""
+import bisect, hashlib, os, threading, time
+
+MEMBER_TTL = 300  # secs without heartbeat after which a member is dropped from the ring
+VNODES = 64       # ring points per member
+
+
+def _hash(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class shard_ring:
+    """ the files this node owns among the live members """
+
+    def __init__(self, members_dir, node_id, members, ttl, proc_c, vnodes=VNODES):
+        self.members_dir = members_dir
+        self.node_id = node_id
+        self.members = members   # configured member ids, None => whoever has a heartbeat
+        self.ttl = ttl
+        self.proc_c = proc_c
+        self.vnodes = vnodes
+        self.live = []
+        self.ring = []
+        self.points = []
+        if not os.path.isdir(members_dir):
+            os.makedirs(members_dir)
+        self.heartbeat()
+        t = threading.Thread(target=self._beat, name="member-heartbeat")
+        t.daemon = True
+        t.start()
+
+    def heartbeat(self):
+        with open("/".join([self.members_dir, self.node_id]), "w") as hfile:
+            hfile.write("%d\n" % (int(time.time())))
+
+    def _beat(self):
+        beat = threading.Event()
+        while True:
+            beat.wait(max(1, self.ttl / 3))
+            try:
+                self.heartbeat()
+            except (IOError, OSError) as oops:
+                self.proc_c.log("Member heartbeat failed: %s" % (oops), 0)
+
+    def _live_members(self):
+        candidates = self.members
+        if candidates is None:
+            candidates = os.listdir(self.members_dir)
+        cutoff = time.time() - self.ttl
+        live = set([self.node_id])
+        for member in candidates:
+            try:
+                if os.path.getmtime("/".join([self.members_dir, member])) >= cutoff:
+                    live.add(member)
+            except OSError:
+                continue
+        return sorted(live)
+
+    def refresh(self):
+        """ rebuild the ring if the live members changed, True if they did """
+        live = self._live_members()
+        if live == self.live:
+            return False
+        self.proc_c.log("Shard members now %s (were %s)" % (", ".join(live), ", ".join(self.live) or "none"), 0)
+        self.live = live
+        self.ring = sorted((_hash("%s#%d" % (member, i)), member) for member in live for i in range(self.vnodes))
+        self.points = [point for point, member in self.ring]
+        return True
+
+    def owner(self, name):
+        i = bisect.bisect(self.points, _hash(name)) % len(self.ring)
+        return self.ring[i][1]
+
+    def owns(self, name):
+        return self.owner(name) == self.node_id
+
+    def mine(self, names):
+        """ yield the names among names that this node owns """
+        nall = nmine = 0
+        for name in names:
+            nall += 1
+            if self.owns(name):
+                nmine += 1
+                yield name
+        self.proc_c.log("Shard %s: %d of %d listed files" % (self.node_id, nmine, nall), 1)
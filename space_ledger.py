@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+Running account of the bytes held in a transfer buffer, so the space check of each loop
+does not have to walk the whole buffer with 'du'.
+
+Every change is appended as one "<bytes> <file name>" line to a shared journal: positive when
+transfer_pipeline lands a file, negative when clean_pipe removes one.  Each daemon keeps its
+own running total by reading the journal lines it has not seen yet.  A full 'du' reconcile
+is only done every reconcile_interval seconds, which also picks up anything added or removed
+behind the pipeline's back.  Point all daemons working on the same buffer at the same journal.
+
+The journal starts with a line naming the buffer directory it keeps account of, and opening it
+for any other directory is refused.  Consumers outside the pipeline that remove files from the
+buffer must append their negative lines to the journal as well; removals it is not told about
+are only picked up by the next reconcile.  The free space of the filesystem (statvfs) is checked
+separately as a safety floor, it is not used to correct the total.
+
+Each reconcile compacts the journal back to its header line.  Writers hold an flock on the
+journal while appending and reopen it if it was replaced meanwhile, so no line is lost.  The
+compacted journal records the reconciled total under its header, and other daemons reading it
+carry on from that total rather than running a 'du' of their own.
+"""
+import errno, fcntl, os, threading, time
+
+GIGABYTES = 1 << 30
+HEADER = "# space ledger of "
+STAMP = "# reconciled to "
+
+
+class ledgerException(Exception):
+    def __init__(self, journal, msg):
+        self.journal = journal
+        self.msg = msg
+    def __str__(self):
+        return "Space ledger '%s': %s" % (self.journal, self.msg)
+
+
+class space_ledger:
+    """ byte ledger for one buffer directory, fed from a shared journal file """
+
+    def __init__(self, buffer_dir, journal, reconcile_interval, proc_c):
+        self.buffer_dir = buffer_dir
+        self.journal = journal
+        self.reconcile_interval = reconcile_interval
+        self.proc_c = proc_c
+        self.lock = threading.Lock()
+        self.total = 0
+        self.offset = 0
+        self.last_reconcile = 0
+        self.header = "%s%s\n" % (HEADER, os.path.realpath(buffer_dir))
+        self._key()
+        self.stamp = None   # line under the header of the journal read from, new on each compaction
+
+    def _key(self):
+        """ tie the journal to buffer_dir on first use, refuse a journal of another directory """
+        buffer_dir = os.path.realpath(self.buffer_dir)
+        try:
+            fd = os.open(self.journal, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError as oops:
+            if oops.errno != errno.EEXIST:
+                raise
+            with open(self.journal) as jfile:
+                first = jfile.readline()
+            if not first.startswith(HEADER):
+                self.proc_c.log("Space ledger %s does not name its buffer, assuming %s" % (self.journal, buffer_dir), 0)
+                return
+            keyed = first[len(HEADER):].strip()
+            if keyed != buffer_dir:
+                raise ledgerException(self.journal, "keeps account of %s, not %s" % (keyed, buffer_dir))
+            return
+        try:
+            os.write(fd, self.header)
+        finally:
+            os.close(fd)
+
+    def _stamp(self, jfile):
+        """ the reconcile line under the header, telling a compacted journal from the one read before """
+        jfile.readline()
+        stamp = jfile.readline()
+        return stamp if stamp.startswith(STAMP) else None
+
+    def _open_locked(self):
+        """ descriptor of the journal for appending, flocked; closing it releases the lock """
+        while True:
+            fd = os.open(self.journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.journal).st_ino:
+                    return fd
+            except OSError:
+                pass
+            os.close(fd)  # --- compacted while we waited for the lock, append to the new one
+
+    def reconcile(self):
+        """ reset the total from a full 'du' of the buffer and compact the journal, return False if du failed """
+        s, o, e = self.proc_c.comm("du -sk %s" % (self.buffer_dir), shell=True, ignore_dry_run=True)
+        if s != 0:
+            return False
+        fd = self._open_locked()
+        try:
+            stamp = "%s%d bytes at %.6f by %d\n" % (STAMP, int(o.split()[0]) * 1024, time.time(), os.getpid())
+            tmp = self.journal + ".tmp"
+            with open(tmp, "w") as tfile:
+                tfile.write(self.header + stamp)
+            os.rename(tmp, self.journal)
+            with self.lock:
+                self.total = int(o.split()[0]) * 1024
+                self.offset = len(self.header + stamp)
+                self.stamp = stamp
+                self.last_reconcile = time.time()
+        finally:
+            os.close(fd)
+        self.proc_c.log("Reconciled buffer usage: %.1f GBs" % (float(self.total) / GIGABYTES), 1)
+        return True
+
+    def add(self, nbytes, fname):
+        """ record nbytes (negative when removed) for fname in the journal """
+        fd = self._open_locked()
+        try:
+            os.write(fd, "%d %s\n" % (nbytes, fname))
+        finally:
+            os.close(fd)
+
+    def _catch_up(self):
+        """ fold in the journal lines written since the last read """
+        with open(self.journal) as jfile:
+            stamp = self._stamp(jfile)
+            if stamp != self.stamp:
+                if stamp is None:
+                    self.last_reconcile = 0  # --- replaced by a journal we cannot follow, reconcile next time
+                    return
+                # --- compacted by another daemon's reconcile, carry on from its total
+                self.total = int(stamp[len(STAMP):].split()[0])
+                self.offset = jfile.tell()
+                self.stamp = stamp
+            jfile.seek(self.offset)
+            for aline in jfile:
+                if not aline.endswith("\n"):
+                    break  # --- still being written, pick it up next time
+                self.offset += len(aline)
+                if aline.startswith("#"):
+                    continue
+                try:
+                    self.total += int(aline.split()[0])
+                except (ValueError, IndexError):
+                    self.proc_c.log("Bad space ledger line: '%s'" % (aline.strip()), 0)
+
+    def used(self):
+        """ bytes in the buffer, reconciling against 'du' when one is due """
+        if time.time() - self.last_reconcile >= self.reconcile_interval:
+            self.reconcile()
+        with self.lock:
+            self._catch_up()
+            return self.total
+
+    def free(self):
+        """ bytes the filesystem holding the buffer still has available, the safety floor under the ledger """
+        st = os.statvfs(self.buffer_dir)
+        return st.f_bavail * st.f_frsize
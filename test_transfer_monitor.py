@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""
+Tests of transfer_monitor fed with globus-url-copy -vb output, whose performance line is
+redrawn in place with carriage returns.
+
+Run as:  python -m unittest test_transfer_monitor
+"""
+import time, unittest
+from process_commands import process_commands
+from transfer_monitor import transfer_monitor
+
+PERF = "%15d bytes         %.2f MB/sec avg         %.2f MB/sec inst\r"
+
+
+class transfer_monitor_test(unittest.TestCase):
+
+    def setUp(self):
+        self.proc_c = process_commands(0)
+
+    def test_carriage_return_lines(self):
+        """ several performance lines in one string all count, the last one wins """
+        monitor = transfer_monitor("test", 1.0, 60, self.proc_c)
+        monitor.line("".join([PERF % (1048576, 1.0, 1.0), PERF % (2097152, 1.5, 2.0)]))
+        self.assertEqual(monitor.nbytes, 2097152)
+        self.assertEqual(monitor.inst, 2.0)
+        self.assertAlmostEqual(monitor.moving, 1.1)
+
+    def test_streamed_while_running(self):
+        """ performance lines reach the monitor while the command runs, not when it has finished """
+        monitor = transfer_monitor("test", 1.0, 60, self.proc_c)
+        seen = []
+        def line(aline):
+            seen.append((time.time(), aline))
+            monitor.line(aline)
+        cmd = "printf '%s'; sleep 1; printf '%s'" % (PERF % (1024, 2.0, 2.0), PERF % (2048, 2.0, 2.0))
+        t0 = time.time()
+        s, o, e = self.proc_c.comm(cmd, shell=True, callback=line)
+        self.assertEqual(s, 0)
+        self.assertEqual([aline.strip().split()[0] for t, aline in seen], ["1024", "2048"])
+        self.assertTrue(seen[0][0] - t0 < 0.9)
+        self.assertEqual(monitor.nbytes, 2048)
+
+    def test_stalled_below_floor(self):
+        """ a transfer reporting only rates below the floor is stalled once the window is over """
+        monitor = transfer_monitor("test", 1.0, 0, self.proc_c)
+        monitor.line(PERF % (1024, 0.1, 0.1))
+        self.assertTrue(monitor.stalled())
+
+
+if __name__ == "__main__":
+    unittest.main()
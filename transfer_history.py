@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""
+History of observed transfer rates per remote endpoint, kept in a json file so it survives
+restarts.  Used to derive transfer deadlines from what a link has actually delivered
+recently rather than from a fixed guess.
+"""
+import threading
+from process_commands import load_json, save_json
+
+MEGABYTES = 1 << 20
+NKEEP = 500             # most recent rates kept per endpoint
+MIN_SAMPLES = 20        # rates needed before percentiles are trusted
+MIN_SAMPLE_BYTES = 64 * MEGABYTES  # smaller files say more about latency than about rate
+
+
+class transfer_history:
+    """ recent MB/s of successful transfers, per endpoint """
+
+    def __init__(self, history_file, proc_c, nkeep=NKEEP):
+        self.history_file = history_file
+        self.proc_c = proc_c
+        self.nkeep = nkeep
+        self.lock = threading.Lock()
+        self.rates = load_json(history_file, {}).get("rates", {})
+        self.dirty = False
+
+    def record(self, endpoint, nbytes, elapsed):
+        """ add the rate of a transfer of nbytes that took elapsed secs """
+        if not nbytes or nbytes < MIN_SAMPLE_BYTES or elapsed <= 0:
+            return
+        rate = float(nbytes) / MEGABYTES / elapsed
+        with self.lock:
+            rates = self.rates.setdefault(endpoint, [])
+            rates.append(rate)
+            del rates[:-self.nkeep]
+            self.dirty = True
+        self.proc_c.log("Recorded %.2f MB/sec for %s" % (rate, endpoint), 2)
+
+    def percentile(self, endpoint, pct):
+        """ the pct-th percentile of the recent rates in MB/s, None until there are enough of them """
+        with self.lock:
+            rates = sorted(self.rates.get(endpoint, []))
+        if len(rates) < MIN_SAMPLES:
+            return None
+        return rates[min(len(rates) - 1, int(len(rates) * pct / 100.0))]
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self.lock:
+            state = dict(rates=dict((endpoint, list(rates)) for endpoint, rates in self.rates.items()))
+            self.dirty = False
+        save_json(self.history_file, state)
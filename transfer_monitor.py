@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+Live throughput of a running globus-url-copy, followed through the performance lines it
+prints with -vb, e.g.
+
+         1048576 bytes         1.00 MB/sec avg         1.00 MB/sec inst
+
+The monitor keeps the instantaneous rate and a moving average of it, and reports the
+transfer as stalled once the rate has stayed below a floor for a whole window (no
+performance line at all counts as no progress), so a hung transfer can be aborted and
+requeued rather than holding its slot for hours.
+"""
+import re, threading, time
+
+PERF_LINE = re.compile(r"^\s*(\d+)\s+bytes\s+([\d.]+)\s+MB/sec avg\s+([\d.]+)\s+MB/sec inst")
+LINE_END = re.compile(r"[\r\n]+")  # -vb redraws the performance line in place with '\r'
+SMOOTHING = 0.1  # weight of the newest sample in the moving average
+
+
+class transfer_monitor:
+    """ throughput and stall state of one globus-url-copy call """
+
+    def __init__(self, label, floor, window, proc_c):
+        self.label = label
+        self.floor = floor
+        self.window = window
+        self.proc_c = proc_c
+        self.lock = threading.Lock()
+        self.t_start = time.time()
+        self.last_good = self.t_start
+        self.nbytes = 0
+        self.inst = 0.0
+        self.moving = None
+        self.stopped = False
+
+    def line(self, aline):
+        """ output callback: pick up the performance lines, also several ended by carriage returns in one string """
+        for part in LINE_END.split(aline):
+            match = PERF_LINE.match(part)
+            if match is not None:
+                self._sample(match)
+
+    def _sample(self, match):
+        with self.lock:
+            self.nbytes = int(match.group(1))
+            self.inst = float(match.group(3))
+            if self.moving is None:
+                self.moving = self.inst
+            else:
+                self.moving += SMOOTHING * (self.inst - self.moving)
+            if self.inst >= self.floor:
+                self.last_good = time.time()
+        self.proc_c.log("%s: %d bytes, %.2f MB/sec inst, %.2f MB/sec moving avg" %
+                        (self.label, self.nbytes, self.inst, self.moving), 2)
+
+    def stalled(self):
+        """ watchdog: True once the rate has been below the floor for the whole window """
+        with self.lock:
+            low_for = time.time() - self.last_good
+        if low_for < self.window:
+            return False
+        self.proc_c.log("%s stalled: below %.2f MB/sec for %d secs (%d bytes moved)" %
+                        (self.label, self.floor, low_for, self.nbytes), 0)
+        self.stopped = True
+        return True
@@ -11,22 +11,58 @@ Model is that code searches a remote source directory for a list of target files
     If 1) & 2) the code then
         a) creates a local status file as ".in_progress"
         b) tranfers the MRK file
+            -) with --marker-cache the MRK files of each listing chunk are fetched ahead in one session
             -) at this point we can read MRK file for information in order to validate transfer
         c) tranfers the target file
             -) on success, it renames status file ".in_progress" to ".done" 
+               (with --verify only once a verifier thread has checked its checksum, against the one 
+               in the MRK file when it has one)
                 -) optionally copies it back to the remote source location for use by local site to clean its cache
+                   (--copy-done; a background thread pushes the done files in batches, see done_publisher.py)
             -) on failure, it deletes all local files and logs info
-
-    After list of target files is exhausted, it sleeps 5 minutes and re-scans the remote source
-
-    ToDo:  
-        Include size information from the MRK file prior to copying target file to set a reasonable timeout
-            (we found this useful during network interuptions)
+               and the file is tried again only after a growing backoff; a file that keeps failing is 
+               quarantined (see retry_queue.py)
+               with --resume, what a failed copy left of a large file is kept and the next try continues 
+               from there (globus-url-copy -off) rather than from byte zero
+
+    After list of target files is exhausted, it re-scans the remote source straight away if the pass 
+    moved files, otherwise it sleeps (--min-sleep, doubling up to --max-sleep) and re-scans.  
+    A change of the state file, or files leaving a full local buffer, cut the sleep short.
+
+    The files pending and in flight are checkpointed, with the process groups of the running copies.
+    On SIGTERM (or SIGINT) no new transfers are started, the ones in flight are finished and the state is
+    saved; a second signal kills the running copies and stops at once.  On startup the copies an earlier
+    instance left running are killed, the files that were in flight are settled (finalized when complete
+    on disk, otherwise resumed with --resume or requeued) and the pending files are transferred in a first
+    pass, before the remote buffer is listed again.  A pass that fails with an exception is logged and the
+    next one started after --min-sleep.
+
+    The size information from the MRK file is used to set a reasonable timeout on the target file copy
+        (--hard-timeout, --rate-timeout or --adaptive-timeout; we found this useful during network interuptions)
 
 Features:
 
     With each loop, verifies valid proxy and that there is room on the local cache
+        (the proxy lifetime is cached; files that would outlast the proxy are held back, and a renewed 
+        proxy file ends the wait for one straight away)
     Can run multiple instances concurrently pointing to the same directory structure
+        (in_progress states are leases taken atomically and kept alive by a heartbeat; a lease left 
+        by a crashed instance is reclaimed after --lease-ttl secs)
+    Can split the remote buffer between instances on several nodes by consistent hashing (--node-id, --members)
+    Can restart warm from a checkpoint of the pending and in-flight files, and drain on SIGTERM
+    Can keep several transfers in flight at once from a bounded worker pool (--max-concurrent)
+    Can group files into multi-file globus-url-copy sessions to save on handshakes (--batch-size)
+    Can keep the remote listing between loops and only check new files (--listing-cache)
+    Can keep transfer status in an indexed sqlite store instead of status files (--status-db)
+    Can keep a running byte ledger of the local buffer instead of a du each loop (--space-ledger)
+    Can size files from their MRK file first, admit them against the free buffer and order them (--order)
+    Can watch the live rate of each transfer and abort & requeue it when it stalls (--stall-rate)
+    Can tune globus-url-copy streams, tcp buffers and concurrency per file size class (--guc-autotune)
+    Can prefetch the MRK files of a listing in one session and size files from memory (--marker-cache)
+    Can verify file content with adler32, crc32 or md5 in a pool of verifier threads (--verify)
+    Can resume failed copies of large files from the bytes already moved (--resume)
+    Can back off from files that keep failing and quarantine them (--retry-base, --max-failures)
+    Can expose cumulative counters and histograms over http or as a node_exporter textfile (--metrics-port, --metrics-file)
 
 """
 
@@ -36,13 +72,28 @@ if sys.version[0:3] < '2.6':
         sys.version[0:5]
     sys.exit(-1)
 
-import math, os, pprint, re, shlex, shutil, socket, stat, time
+import math, os, pprint, re, shlex, shutil, socket, stat, time, traceback
 from datetime import datetime
-from signal import alarm, signal, SIGALRM, SIGKILL, SIGTERM
+from signal import alarm, signal, siginterrupt, SIGALRM, SIGINT, SIGKILL, SIGTERM
 from subprocess import Popen, PIPE, STDOUT
+import threading, Queue, tempfile
 import argparse
 from ConfigParser import RawConfigParser
-from process_commands import process_commands
+from process_commands import process_commands, load_json, save_json, WATCH_INTERVAL
+from transfer_status import open_status, LEASE_TTL
+from space_ledger import space_ledger, GIGABYTES
+from pipe_scheduler import pipe_scheduler, CHANGED, REMOVED
+from transfer_monitor import transfer_monitor
+from transfer_history import transfer_history
+from guc_tuner import guc_tuner, DEFAULT_BS
+from pipe_metrics import pipe_metrics, SECONDS_BUCKETS, RATE_BUCKETS, SCAN_BUCKETS
+from grid_proxy import grid_proxy
+from retry_queue import retry_queue, BASE_DELAY, MAX_DELAY, MAX_FAILURES
+from checksum_pool import checksum_pool, marker_checksum, ALGORITHMS
+from marker_cache import marker_cache
+from done_publisher import done_publisher, FLUSH_SECS, FLUSH_FILES
+from shard_ring import shard_ring, MEMBER_TTL
+from pipe_checkpoint import pipe_checkpoint
 import json
 
 #-------------------
@@ -68,12 +119,150 @@ DOINGTYPE="in_progress"
 
 BUFFERSIZE = 40000
 MIN_BUFFER = 100
+RECONCILE_INTERVAL = 21600  # seconds between full 'du' reconciles of the space ledger
 
 GUC_PARALLEL = "8"
 HARD_TIMEOUT = 0
 RATE_TIMEOUT = 0  # MB/s timeout, 0 => off
 MIN_TIMEOUT = 15
+HISTORY_FILE = "transfer_pipeline.history"
+TIMEOUT_PERCENTILE = 5  # percentile of recent rates the adaptive timeout is based on
+TIMEOUT_MARGIN = 3.0    # safety factor on the adaptive timeout
+STALL_RATE = 0     # MB/s floor of the stall watchdog, 0 => off
+STALL_WINDOW = 300  # secs a transfer may stay below the floor
 MEGABYTES = 1 << 20  # the number of bytes in a MB
+RESUME_MIN = 64  # MB a failed copy must have moved for --resume to keep it
+
+MAX_CONCURRENT = 1  # number of transfers kept in flight, 1 => serial
+BATCH_SIZE = 0  # files per globus-url-copy -f session, 0 => one session per file
+GUC_CONCURRENCY = "4"
+GUC_PARALLEL_MAX = 16
+GUC_CONCURRENCY_MAX = 16
+TCP_BS_CHOICES = "0,4M,16M,64M"  # 0 => globus-url-copy default
+TUNER_FILE = "transfer_pipeline.tuning"
+
+FULL_RESCAN = 3600  # seconds between full rescans of the remote listing
+STATUS_CHUNK = 500  # listed files checked against the status store at once
+
+MIN_SLEEP = 30    # sleep after an idle pass, doubled for each further idle pass
+MAX_SLEEP = 360   # up to this
+HOLD_SLEEP = 360  # sleep while on hold or without proxy
+
+ORDERS = ["listing", "smallest", "oldest", "largest"]
+STAGE_WINDOW = 100  # files staged (MRK fetched & sized) per pass when ordering
+
+METRICS_PORT = 0  # http port serving metrics, 0 => off
+METRICS_ADDR = "localhost"
+FAILURES = ["copy_fail", "mrk_fail", "os_error"]  # tally keys also counted as failures_total{type=...}
+
+RETRY_FILE = "transfer_pipeline.retries"
+CHECKSUM_FILE = "transfer_pipeline.checksums"
+UNPUBLISHED_FILE = "transfer_pipeline.unpublished"
+MEMBERS_DIR = "members"
+CHECKPOINT_FILE = "transfer_pipeline.checkpoint"
+GUC_COMMAND = "globus-url-copy"
+VERIFY_WORKERS = 2
+
+
+class listing_pairs:
+    """
+        pairs each data file (ending in ftype) with its marker file (data file + "." + mtype)
+        as listing entries are added.  Two hashed sets hold only the entries still waiting for 
+        their partner, so pairing is O(n) and memory stays bounded by the unmatched entries.
+    """
+
+    def __init__(self, ftype, mtype):
+        self.ftype = ftype
+        self.msuffix = "." + mtype
+        self.data = set()
+        self.markers = set()
+
+    def add(self, afile):
+        """ add a listing entry, returns the data file if this entry completes its pair """
+        if afile.endswith(self.msuffix):
+            dfile = afile[:-len(self.msuffix)]
+            if dfile in self.data:
+                self.data.discard(dfile)
+                return dfile
+            if dfile.endswith(self.ftype):
+                self.markers.add(dfile)
+        elif afile.endswith(self.ftype):
+            if afile in self.markers:
+                self.markers.discard(afile)
+                return afile
+            self.data.add(afile)
+        return None
+
+
+def pair_listing(names, ftype, mtype):
+    """ yield each data file among names as soon as its marker file has been seen too """
+    pairs = listing_pairs(ftype, mtype)
+    for afile in names:
+        dfile = pairs.add(afile)
+        if dfile is not None:
+            yield dfile
+
+
+class listing_cache:
+    """ 
+        persistent snapshot of the remote listing between scan loops.  Only names that are 
+        new since the previous snapshot (or were handed back for a retry) are passed on, 
+        except on a scheduled full rescan when every name is passed on again.
+    """
+
+    def __init__(self, cache_file, rescan_interval, proc_c):
+        self.cache_file = cache_file
+        self.rescan_interval = rescan_interval
+        self.proc_c = proc_c
+        self.lock = threading.Lock()
+        state = load_json(cache_file, {})
+        self.seen = state.get("seen", {})      # name -> unix time it was first listed
+        self.retry = set(state.get("retry", []))
+        self.last_full = state.get("last_full", 0)
+        self.dirty = False
+
+    def candidates(self, names):
+        """ yield the names worth checking this pass, then make this listing the snapshot """
+        now = int(time.time())
+        full = now - self.last_full >= self.rescan_interval
+        current = {}
+        nnew = 0
+        for afile in names:
+            first_seen = self.seen.get(afile)
+            if first_seen is None:
+                nnew += 1
+                current[afile] = now
+            else:
+                current[afile] = first_seen
+            with self.lock:
+                retry = afile in self.retry
+                self.retry.discard(afile)
+            if first_seen is None or full or retry:
+                yield afile
+        nremoved = len(self.seen) - (len(current) - nnew)
+        self.proc_c.log("Listing: %d entries, %d new, %d removed%s" % 
+                        (len(current), nnew, nremoved, full and " (full rescan)" or ""), 1)
+        self.seen = current
+        if full:
+            self.last_full = now
+        self.dirty = self.dirty or full or nnew > 0 or nremoved > 0
+
+    def forget(self, afile):
+        """ have afile passed on again with the next listing, e.g. after a failed transfer """
+        with self.lock:
+            self.retry.add(afile)
+            self.dirty = True
+
+    def first_seen(self, afile):
+        return self.seen.get(afile)
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self.lock:
+            state = dict(seen=self.seen, retry=sorted(self.retry), last_full=self.last_full)
+            self.dirty = False
+        save_json(self.cache_file, state)
 
 
 class transfer_pipeline:
@@ -97,18 +286,91 @@ class transfer_pipeline:
         self.time_to_notify=args.time_to_notify
         self.proc_name = PROC_NAME
         self.email_addr = args.email_addr
+        self.max_concurrent = args.max_concurrent
+        self.budget = 0
+        self.tally_lock = threading.Lock()
 
         self.proc_c = process_commands(args.verbosity)
+        self.scheduler = pipe_scheduler(args.min_sleep, args.max_sleep, self.proc_c)
+        self.scheduler.watch("state", self.trans_status, CHANGED, [self.state_file])
+        self.scheduler.watch("space", self.trans_dir, REMOVED)
+        self.proxy = grid_proxy(self.proc_c)
+        self.scheduler.watch("proxy", os.path.dirname(self.proxy.path), CHANGED, [os.path.basename(self.proxy.path)])
+        self.status = open_status(args.status_db, self.trans_status, self.proc_c, args.lease_ttl)
+        self.space = None
+        if not args.space_ledger == "None":
+            self.space = space_ledger(self.trans_dir, args.space_ledger, args.reconcile_interval, self.proc_c)
+        self.history = None
+        if args.adaptive_timeout:
+            self.history = transfer_history("/".join([self.trans_status,args.history_file]), self.proc_c)
+        self.tuner = None
+        if args.guc_autotune:
+            self.tuner = guc_tuner("/".join([self.trans_status,args.tuner_file]), int(args.guc_parallel),
+                                   args.guc_parallel_max, args.tcp_bs_choices.split(","),
+                                   int(args.guc_concurrency), args.guc_concurrency_max, self.proc_c)
+        self.retries = retry_queue("/".join([self.trans_status,args.retry_file]), args.retry_base,
+                                   args.retry_max, args.max_failures, self.proc_c)
+        self.markers = None
+        if not args.marker_cache == "None":
+            self.markers = marker_cache(args.marker_cache, self.mtype, self.proc_c)
+        self.verifier = None
+        if not args.verify == "None":
+            self.verifier = checksum_pool(args.verify_workers, args.verify,
+                                          "/".join([self.trans_status,args.checksum_file]), self.proc_c)
+        self.publisher = None
+        if args.copy_done_to_remote:
+            self.publisher = done_publisher(self.status, "%s/%s" % (self.remote_url, self.remote_dir),
+                                            lambda listfile, timeout: self._call_guc_batch(listfile, timeout, None),
+                                            "/".join([self.trans_status,UNPUBLISHED_FILE]),
+                                            args.done_flush_secs, args.done_flush_files, self.proc_c)
+        self.shards = None
+        if not args.node_id == "None":
+            members = None
+            if not args.members == "None":
+                members = args.members.split(",")
+            self.shards = shard_ring("/".join([self.trans_status,MEMBERS_DIR]), args.node_id, members,
+                                     args.member_ttl, self.proc_c)
+        self.listing = None
+        if not args.listing_cache == "None":
+            self.listing = listing_cache(args.listing_cache, args.full_rescan, self.proc_c)
+        node = args.node_id
+        if node == "None":
+            node = socket.gethostname()
+        self.checkpoint = pipe_checkpoint("/".join([self.trans_status,"%s.%s" % (CHECKPOINT_FILE, node)]),
+                                          self.status.leases.owner, self.proc_c)
+        self.stopping = False
+        self.metrics = self._metrics()
 
 #        self._logIndent = 0
         self.proc_c.log("opts: %s" % (self.args), 4)
 
 
+#-----------------------------------
+    def _metrics(self):
+        """ cumulative metrics of this daemon, served and/or exported when asked for """
+        metrics = pipe_metrics("transfer_pipeline_", self.proc_c, self.args.metrics_file)
+        metrics.describe("passes_total", "counter", "Scan and transfer passes run")
+        metrics.describe("files_transferred_total", "counter", "Files transferred and validated")
+        metrics.describe("bytes_transferred_total", "counter", "Bytes of files transferred and validated")
+        metrics.describe("failures_total", "counter", "Failures by type")
+        metrics.describe("transfer_seconds", "histogram", "Time taken per transferred file", SECONDS_BUCKETS)
+        metrics.describe("transfer_rate_mbps", "histogram", "MB/s per transferred file", RATE_BUCKETS)
+        metrics.describe("scan_seconds", "histogram", "Time taken by the remote listing", SCAN_BUCKETS)
+        metrics.describe("queue_depth", "gauge", "Files found waiting for transfer by the last scan")
+        metrics.describe("buffer_used_bytes", "gauge", "Bytes held in the local buffer")
+        metrics.describe("buffer_size_bytes", "gauge", "Size the local buffer may grow to")
+        metrics.describe("retry_files", "gauge", "Failed files by state in the retry queue")
+        metrics.set("buffer_size_bytes", BUFFERSIZE * GIGABYTES)
+        for key in FAILURES:
+            metrics.inc("failures_total", 0, dict(type=key))
+        if self.args.metrics_port > 0:
+            metrics.serve(self.args.metrics_addr, self.args.metrics_port)
+        return metrics
+
 #-----------------------------------
     def check_proxy(self):
         """ Check for valid proxy, return True/False"""
-        s, _o, _e = self.proc_c.comm("grid-proxy-info -e", shell=True,ignore_dry_run=True)
-        return s == 0
+        return self.proxy.valid()
 
 #-----------------------------------
     def check_hold(self):
@@ -135,12 +397,18 @@ class transfer_pipeline:
 
 #-----------------------------------
     def local_space(self):
+        """ True if the local buffer has room, also sets the byte budget for admitting files """
+        self.budget = 0
+        if self.space is not None:
+            return self._ledger_space()
         gbs=0
         cmd="du -s %s" % (self.trans_dir)
         s, o, e = self.proc_c.comm(cmd,shell=True,ignore_dry_run=True)
         if s == 0:
             mitems = o.split()
+            self.metrics.set("buffer_used_bytes", int(mitems[0]) * 1024)
             gbs = BUFFERSIZE - (int(mitems[0]))/(1024*1024)
+            self.budget = (gbs - MIN_BUFFER) * GIGABYTES
             self.proc_c.log("Local Space Avail: %s GBs" % (gbs),1)
             if gbs > MIN_BUFFER:
                 return True
@@ -149,10 +417,17 @@ class transfer_pipeline:
         return False
 
 #-----------------------------------
-    def checkMarkerFile(self, afile, flist):
-        for xfile in flist:
-            if xfile == afile:
-                return True
+    def _ledger_space(self):
+        """ local_space from the byte ledger, with statvfs as a check on the filesystem itself """
+        used, free = self.space.used(), self.space.free()
+        self.metrics.set("buffer_used_bytes", used)
+        gbs = BUFFERSIZE - used / GIGABYTES
+        fsgbs = free / GIGABYTES
+        self.budget = min((BUFFERSIZE - MIN_BUFFER) * GIGABYTES - used, free - MIN_BUFFER * GIGABYTES)
+        self.proc_c.log("Local Space Avail: %s GBs (filesystem %s GBs)" % (gbs, fsgbs),1)
+        if gbs > MIN_BUFFER and fsgbs > MIN_BUFFER:
+            return True
+        self.proc_c.log("Insufficient space available",1)
         return False
 
 #-----------------------------------
@@ -162,13 +437,20 @@ class transfer_pipeline:
         """
         cmd = "globus-url-copy -list %s" % "/".join([self.remote_url,rdir])
         self.proc_c.log(" Command:: '%s'" % (cmd), 4)
-        s, o, e = self.proc_c.comm(cmd)
-        if s == 0:
-            flist = o.split()
-            for afile in flist:
+        pairs = listing_pairs(self.ftype, self.mtype)
+        found = []
+        def take(line):
+            for afile in line.split():
                 self.proc_c.log("Next File is: '%s'" % (afile),1)
-                if afile.endswith(self.ftype) and self.checkMarkerFile(".".join([afile,self.mtype]),flist):
-                    yield afile  
+                dfile = pairs.add(afile)
+                if dfile is not None:
+                    found.append(dfile)
+
+        s, o, e = self.proc_c.comm(cmd, callback=take)
+        self.metrics.observe("scan_seconds", e)
+        if s == 0:
+            for afile in found:
+                yield afile  
                       
 #-----------------------------------
     def getfiles_fromlist(self, rdir):
@@ -182,43 +464,83 @@ class transfer_pipeline:
         s, o, e = self.proc_c.comm(cmd)
         if s == 0:
             with open("rawfilelist.txt") as rflist:
-                mylines = rflist.readlines()
-                for aline in mylines:
-                    afile = aline.rsplit('\n')
-                    self.proc_c.log("Next file is: '%s'" % (afile),1)
-                    if afile.endswith(self.ftype) and self.checkMarkerFile(".".join([afile,self.mtype]),flist):
-                        yield afile
+                names = (aline.strip() for aline in rflist)
+                for afile in pair_listing(self._logged(names), self.ftype, self.mtype):
+                    yield afile
             os.remove("rawfilelist.txt")
 
+#-----------------------------------
+    def _logged(self, names):
+        for afile in names:
+            self.proc_c.log("Next File is: '%s'" % (afile),1)
+            yield afile
+
 
 #-----------------------------------
     def _calc_timeout(self, size):
         """ 
             Calculate the timeout to be used based on the size of the file to be transfered 
-            and values of hard, rate and min timeout settings. 
+            and values of hard, adaptive, rate and min timeout settings.  A size of None 
+            (not known) only gets the hard timeout.
         """
 
-        # check for defaults
-        if self.args.hard_timeout == HARD_TIMEOUT and \
-           self.args.rate_timeout == RATE_TIMEOUT:
-            return 0
-
-        # hard timeout overrides rate timeout
+        # hard timeout overrides all others
         if self.args.hard_timeout != HARD_TIMEOUT:
             return self.args.hard_timeout
+        if size is None:
+            return 0
+
+        # adaptive timeout from the recent rates seen on this endpoint, once there are enough
+        if self.args.adaptive_timeout:
+            rate = self.history.percentile(self.remote_url, self.args.timeout_percentile)
+            if rate is not None:
+                adaptive_timeout = math.ceil(self.args.timeout_margin * float(size) / 
+                                             (rate * MEGABYTES))
+                return int(max(MIN_TIMEOUT, adaptive_timeout))
+
+        if self.args.rate_timeout == RATE_TIMEOUT:
+            return 0
 
         # rate timeout is set, round up
         rate_timeout = math.ceil(float(size) /
                                  (self.args.rate_timeout * MEGABYTES))
-        return max(MIN_TIMEOUT, rate_timeout) 
+        return int(max(MIN_TIMEOUT, rate_timeout))
 
 #------------------------
-    def is_ready_to_transfer(self,fname):
-        localfile="/".join([self.trans_status,fname]);
-        if os.path.isfile(".".join([localfile,self.done])) or os.path.isfile(".".join([localfile,self.doing])):
+    def _duration(self, size):
+        """ expected secs to move size bytes, from the recent median rate or --rate-timeout, 0 if not known """
+        if not size:
+            return 0
+        rate = None
+        if self.history is not None:
+            rate = self.history.percentile(self.remote_url, 50)
+        if rate is None and self.args.rate_timeout != RATE_TIMEOUT:
+            rate = self.args.rate_timeout
+        if not rate:
+            return 0
+        return int(math.ceil(float(size) / (rate * MEGABYTES)))
+
+#------------------------
+    def _outlasts_proxy(self, tfile, duration, tally):
+        """ hand back tfile if the proxy would expire before a transfer of duration secs is done """
+        if self.proxy.valid(duration):
             return False
+        self.proc_c.log("Holding back %s, the proxy would expire during its transfer" % (tfile), 0)
+        self._unstage(tfile, tally)
         return True
 
+#------------------------
+    def is_ready_to_transfer(self,fname):
+        return len(self.status.ready([fname])) > 0
+
+#------------------------
+    def _count(self, tally, key, value=1):
+        """ update a tally counter, safe to call from the transfer workers """
+        with self.tally_lock:
+            tally[key] += value
+        if key in FAILURES:
+            self.metrics.inc("failures_total", value, dict(type=key))
+
 #------------------------
     def _unixT(self):
         return int(time.mktime((datetime.now()).timetuple()))
@@ -226,144 +548,701 @@ class transfer_pipeline:
 #------------------------
     def manage_lock(self,fname,ltype,tally):
         """
-            change lock files based on ltype input requested:
-            if 'done' then rename in_progess file to done
-            if 'doing' then create the in_progress file
-            if 'failed' then remove the in_progress file
+            change lock (status store entry) based on ltype input requested:
+            if 'done' then move in_progess to done
+            if 'doing' then create the in_progress entry
+            if 'failed' then drop the in_progress entry
             catch errors
         """
-        localfile="/".join([self.trans_status,fname])
-        progressfile=".".join([localfile,self.doing])
         if ltype == self.done:
-            donefile=".".join([localfile,self.done])
             try:
-                os.rename(progressfile,donefile)
+                self.status.finish(fname)
             except:
-                tally['os_error']+=1
+                self._count(tally,'os_error')
                 self.proc_c.log("Copying file to done failed for %s" % (fname), 0)
                 return False
-            if self.args.copy_done_to_remote:
-                remotedone="%s/%s/" % (self.remote_url,self.remote_dir)
-                self.proc_c.log("prog=%s , done=%s, remotedone=%s" % (progressfile, donefile, remotedone), 1)
-                r, e = self.copy_file(donefile, remotedone, self.timeout)
-                if not r:
-                    self.proc_c.log("Copy remote transfer done file failed %s" % (fname), 0)
+            if self.publisher is not None:
+                self.publisher.add(fname)
 
         elif ltype == self.doing:
-            cmd = "echo \"%s\" > %s" % (self._unixT(),progressfile)
-            s, o, e = self.proc_c.comm(cmd, shell=True)
-            if not s == 0:
+            if not self.status.claim(fname):
                 self.proc_c.log("Can't create new local lock file for '%s' " % (fname), 0)
+                self.checkpoint.finished(fname)
                 return False
+            self.checkpoint.started(fname)
         elif ltype == "failed":
             try:
-                os.remove(progressfile)
+                self.status.release(fname)
             except:
-                tally['os_error']+=1
-                self.proc_c.log("Can't remove local file = '%s' " % (sfile), 0)
+                self._count(tally,'os_error')
+                self.proc_c.log("Can't remove local lock for '%s' " % (fname), 0)
                 return False
         return True
 
 #------------------------
-    def copy_file(self, src, dest, timeout):
+    def copy_file(self, src, dest, timeout, choice=None, offset=0):
         self.proc_c.log("copying: %s" % (src), 1)
         ret = False
         elapsed = 0
-        ret, elapsed = self._call_guc(src, dest, timeout)
+        ret, elapsed = self._call_guc(src, dest, timeout, choice, offset)
         return ret, elapsed
 
 #------------------------
-    def _call_guc(self, src, dest, timeout):
+    def _choose(self, nbytes, batch=False):
+        """ tuned globus-url-copy settings for a transfer of nbytes, None when not tuning """
+        if self.tuner is None:
+            return None
+        return self.tuner.choose(nbytes, batch)
+
+#------------------------
+    def _guc_opts(self, choice):
+        """ globus-url-copy options shared by single and batch copies """
+        if choice is None:
+            guc_opts = "-p %s" % (self.args.guc_parallel)
+        else:
+            cls, (parallel, tcp_bs, concurrency) = choice
+            guc_opts = "-p %d" % (parallel)
+            if tcp_bs != DEFAULT_BS:
+                guc_opts += " -tcp-bs %s" % (tcp_bs)
+        # --- the stall watchdog needs the performance lines
+        if self.args.verbosity >= 1 or self.args.stall_rate > 0:
+            guc_opts += " -vb"
+        return guc_opts
+
+#------------------------
+    def _call_guc(self, src, dest, timeout, choice, offset=0):
         """ helper function to copy_file to do just the
-        globus-url-copy call."""
+        globus-url-copy call, from byte offset on if given."""
 
-        guc_verbose = ""
-        if self.args.verbosity >= 1:
-            guc_verbose = "-vb"
+        guc_opts = self._guc_opts(choice)
+        if offset > 0:
+            guc_opts += " -off %d" % (offset)
+        guc_cmd = "globus-url-copy %s %s %s" % (guc_opts, src, dest)
+        return self._run_guc(guc_cmd, timeout, os.path.basename(src))
 
-        guc_cmd = "globus-url-copy -p %s %s %s %s" % \
-                   (self.args.guc_parallel, guc_verbose, src, dest)
+#------------------------
+    def _call_guc_batch(self, listfile, timeout, choice):
+        """ 
+            run every src/dest pair in listfile through one globus-url-copy session,
+            continuing past failed entries so the rest of the batch still moves
+        """
+        guc_opts = self._guc_opts(choice)
+        if self.args.guc_pipeline:
+            guc_opts += " -pp"
+        concurrency = self.args.guc_concurrency
+        if choice is not None:
+            concurrency = choice[1][2]
+        guc_cmd = "globus-url-copy %s -cc %s -c -f %s" % \
+                   (guc_opts, concurrency, listfile)
+        return self._run_guc(guc_cmd, timeout, os.path.basename(listfile))
 
+#------------------------
+    def _run_guc(self, guc_cmd, timeout, label):
         self.proc_c.log("GUC : '%s'" % (guc_cmd),1)
-        # call the copy command
-        s, o, e = self.proc_c.comm(guc_cmd, self.timeout)
+        # --- the copy runs in its own process group, checkpointed so a restart can stop it if we die
+        pgids = []
+        def started(pgid):
+            pgids.append(pgid)
+            self.checkpoint.running(pgid, GUC_COMMAND)
+        # call the copy command, -vb performance lines are logged as they come
+        try:
+            if self.args.stall_rate > 0:
+                monitor = transfer_monitor(label, self.args.stall_rate, self.args.stall_window, self.proc_c)
+                s, o, e = self.proc_c.comm(guc_cmd, timeout=timeout, started=started,
+                                           callback=monitor.line, watchdog=monitor.stalled)
+            else:
+                s, o, e = self.proc_c.comm(guc_cmd, timeout=timeout, started=started,
+                                           callback=lambda line: self.proc_c.log(line.rstrip(), 2))
+        finally:
+            for pgid in pgids:
+                self.checkpoint.exited(pgid)
         if s != 0:
             self.proc_c.log("command failed: %s" % (guc_cmd), 0)
             self.proc_c.log("output: %s" % (o), 0)
             return False, e
 
-        self.proc_c.log(o, 2)
         return True, e
 
+#------------------------
+    def _marker_size(self, fname):
+        """ expected size in bytes from the marker cache or the local MRK file of fname, None if it can't be read """
+        if self.markers is not None:
+            esize = self.markers.size(os.path.basename(fname))
+            if esize is not None:
+                return esize
+        try:
+            with open(".".join([fname,self.mtype])) as mfile:
+                return int(mfile.readline().split(" ")[0])*1024
+        except (IOError, ValueError):
+            return None
+
 #------------------------
     def validate_transfer(self,fname):
-        mrkfile=".".join([fname,self.mtype])
-        esize = 0
-        for aline in open(mrkfile):
-            finfo = aline.split(" ")
-            try:
-                esize = int(finfo[0])*1024
-            except:
-                self.proc_c.log("expected size not evaluated %s" & (finfo[0]), 0)
-                return 2, esize
-            diff_size = abs(int(os.stat(fname).st_size) - esize)
-            self.proc_c.log("Size diff = %d" % (diff_size), 1)
-            if diff_size/1024 >= 1:
-                return 1, esize
+        esize = self._marker_size(fname)
+        if esize is None:
+            self.proc_c.log("expected size not evaluated for %s" % (fname), 0)
+            return 2, 0
+        diff_size = abs(int(os.stat(fname).st_size) - esize)
+        self.proc_c.log("Size diff = %d" % (diff_size), 1)
+        if diff_size/1024 >= 1:
+            return 1, esize
         return 0, esize
 
+#------------------------
+    def _local_paths(self, tfile):
+        """ remote url, local file and local grid url of a target file """
+        remotefile="%s/%s/%s" % (self.remote_url, self.remote_dir, tfile)
+        localfile="/".join([self.trans_dir,tfile])
+        localgridfile ="/".join([self.local_url,localfile]) # --- the gridfile has the url for the local grid endpoint
+        return remotefile, localfile, localgridfile
+
 #------------------------
     def transfer_file(self, tfile, tally):
 
+        if self._stopped([tfile], tally, claimed=False):
+            return False
         if not self.manage_lock(tfile,self.doing,tally):
             return False
 
-        self.proc_c.log("Transfering File = %s" % (tfile), 0)
-        remotefile="%s/%s/%s" % (self.remote_url, self.remote_dir, tfile)
-        localfile="/".join([self.trans_dir,tfile])
-        localgridfile ="/".join([self.local_url,localfile]) # --- the gridfile has the url for the local grid endpoint
         # --- start by copying the MRK file
-        r, etime = self.copy_file(".".join([remotefile,self.mtype]),".".join([localgridfile,self.mtype]),timeout=0)
-        v, esize = 0,0
-        if not r:
-            tally['copy_fail']+=1
-            tally['mrk_fail']+=1
-            self.proc_c.log("Transfer of marker failed for %s" % (tfile), 0)
-            self.manage_lock(tfile,"failed",tally)
-            try:
-                os.remove(".".join([localfile,self.mtype]))
-            except:
-                self.proc_c.log("OS ERROR removing mrk file for %s" % (tfile),0)
-                tally['os_error']+=1
+        if not self._fetch_marker(tfile):
+            self._marker_failed(tfile, tally)
             return False
 
         # --- now do target file
-        r, etime = self.copy_file(remotefile,localgridfile,0)
+        return self.transfer_data(tfile, tally)
+
+#------------------------
+    def _fetch_marker(self, tfile):
+        """ copy the MRK file of tfile next to where the target file will land, from the marker cache if it is there """
+        remotefile, localfile, localgridfile = self._local_paths(tfile)
+        if self.markers is not None and self.markers.take(tfile, ".".join([localfile,self.mtype])):
+            return True
+        r, etime = self.copy_file(".".join([remotefile,self.mtype]),".".join([localgridfile,self.mtype]),
+                                  self._calc_timeout(None), self._choose(None))
+        return r
+
+#------------------------
+    def transfer_data(self, tfile, tally):
+        """ copy the target file of a claimed tfile whose MRK file is already local """
+        self.proc_c.log("Transfering File = %s" % (tfile), 0)
+        if self._stopped([tfile], tally):
+            return False
+        remotefile, localfile, localgridfile = self._local_paths(tfile)
+        esize = self._marker_size(localfile)
+        if self._outlasts_proxy(tfile, self._duration(esize), tally):
+            return False
+        offset = self._resume_offset(localfile, esize)
+        if offset > 0:
+            self.proc_c.log("Resuming %s from byte %d" % (tfile, offset), 0)
+        moved = esize and esize - offset
+        choice = self._choose(esize)
+        r, etime = self.copy_file(remotefile,localgridfile,self._calc_timeout(moved),choice,offset)
+        if not self._finish_transfer(tfile, r, etime, tally, offset):
+            return False
+        if self.history is not None:
+            self.history.record(self.remote_url, moved, etime)
+        if self.tuner is not None:
+            self.tuner.record(choice, moved, etime)
+        return True
+
+#------------------------
+    def _resume_offset(self, localfile, esize):
+        """ with --resume, the bytes an earlier failed copy left in localfile, 0 to start from scratch """
+        if not self.args.resume or esize is None or not os.path.isfile(localfile):
+            return 0
+        size = os.path.getsize(localfile)
+        if size >= esize:
+            return 0
+        return size
+
+#------------------------
+    def _keep_partial(self, tfile, offset):
+        """ with --resume, True if what a failed copy left of tfile is worth continuing from """
+        if not self.args.resume:
+            return False
+        localfile="/".join([self.trans_dir,tfile])
+        esize = self._marker_size(localfile)
+        try:
+            size = os.path.getsize(localfile)
+        except OSError:
+            return False
+        if esize is None or size < self.args.resume_min * MEGABYTES or size >= esize:
+            return False
+        self.proc_c.log("Keeping %d of %d bytes of %s to resume from" % (size, esize, tfile), 0)
+        if self.space is not None:
+            self.space.add(size - offset, tfile)
+        return True
+
+#------------------------
+    def transfer_batch(self, tfiles, tally):
+        """
+            transfer a group of target files and their MRK files in a single
+            globus-url-copy -f session, then judge each file on its own
+        """
+        if self._stopped(tfiles, tally, claimed=False):
+            return False
+        claimed = [tfile for tfile in tfiles if self.manage_lock(tfile,self.doing,tally)]
+        if self.markers is None:
+            return self._batch_session(claimed, True, tally)
+        # --- MRK files come from the marker cache, the session only moves data
+        fetched = []
+        for tfile in claimed:
+            if self._fetch_marker(tfile):
+                fetched.append(tfile)
+            else:
+                self._marker_failed(tfile, tally)
+        return self._batch_session(fetched, False, tally)
+
+#------------------------
+    def transfer_data_batch(self, tfiles, tally):
+        """ as transfer_batch for claimed files whose MRK files are already local """
+        kept = []
+        duration = 0
+        for tfile in tfiles:
+            duration += self._duration(self._marker_size("/".join([self.trans_dir,tfile])))
+            if not self._outlasts_proxy(tfile, duration, tally):
+                kept.append(tfile)
+        return self._batch_session(kept, False, tally)
+
+#------------------------
+    def _batch_session(self, tfiles, with_markers, tally):
+        if not tfiles or self._stopped(tfiles, tally):
+            return False
+
+        self.proc_c.log("Transfering batch of %d files" % (len(tfiles)), 0)
+        fd, listfile = tempfile.mkstemp(prefix="guc_batch.", suffix=".lst")
+        try:
+            with os.fdopen(fd, "w") as flist:
+                for tfile in tfiles:
+                    remotefile, localfile, localgridfile = self._local_paths(tfile)
+                    if with_markers:
+                        flist.write("%s.%s %s.%s\n" % (remotefile, self.mtype, localgridfile, self.mtype))
+                    flist.write("%s %s\n" % (remotefile, localgridfile))
+            choice = self._choose(None, batch=True)
+            r, session_time = self._call_guc_batch(listfile, self._batch_timeout(tfiles, with_markers), choice)
+        finally:
+            os.remove(listfile)
+
+        # --- the session either moved a file or not, the local copies tell which
+        etime = session_time / len(tfiles)
+        moved = 0
+        for tfile in tfiles:
+            remotefile, localfile, localgridfile = self._local_paths(tfile)
+            if not os.path.isfile(".".join([localfile,self.mtype])):
+                self._marker_failed(tfile, tally)
+                continue
+            esize = self._marker_size(localfile)
+            if self._finish_transfer(tfile, os.path.isfile(localfile), etime, tally):
+                moved += esize
+        if self.tuner is not None:
+            self.tuner.record(choice, moved, session_time)
+        return r
+
+#------------------------
+    def _batch_timeout(self, tfiles, with_markers):
+        """ timeout of a batch session, from the total size when every MRK file is already local """
+        if with_markers:
+            return self._calc_timeout(None)
+        total = 0
+        for tfile in tfiles:
+            esize = self._marker_size("/".join([self.trans_dir,tfile]))
+            if esize is None:
+                return self._calc_timeout(None)
+            total += esize
+        return self._calc_timeout(total)
+
+#------------------------
+    def schedule(self, tfiles, tally):
+        """
+            staging pass for --order: claim up to stage_window files and fetch their MRK files 
+            to learn their sizes, then admit files against the free buffer in the order of the 
+            policy.  Files that do not fit, or fall outside the window, are left for a later pass.
+        """
+        staged = []
+        for tfile in tfiles:
+            if len(staged) >= self.args.stage_window:
+                self._count(tally,'copy_tries',-1)
+                self._requeue(tfile)
+                continue
+            if not self.manage_lock(tfile,self.doing,tally):
+                continue
+            if not self._fetch_marker(tfile):
+                self._marker_failed(tfile, tally)
+                continue
+            staged.append((tfile, self._marker_size("/".join([self.trans_dir,tfile]))))
+
+        budget = self.budget
+        admitted = []
+        for tfile, esize in self._ordered(staged):
+            # --- an unreadable MRK file is let through for validate_transfer to report
+            if esize is None or esize <= budget:
+                admitted.append(tfile)
+                budget -= esize or 0
+            else:
+                self._unstage(tfile, tally)
+        self.proc_c.log("Admitted %d of %d staged files, %d GBs of budget left" % 
+                        (len(admitted), len(staged), budget / GIGABYTES), 1)
+        return admitted
+
+#------------------------
+    def _ordered(self, staged):
+        """ staged (file, size) pairs in the order given by --order """
+        if self.args.order == "smallest":
+            return sorted(staged, key=lambda fs: fs[1])
+        if self.args.order == "largest":
+            # --- largest first, smaller ones then fill the space the large ones leave
+            return sorted(staged, key=lambda fs: fs[1], reverse=True)
+        if self.args.order == "oldest" and self.listing is not None:
+            return sorted(staged, key=lambda fs: self.listing.first_seen(fs[0]) or 0)
+        return staged
+
+#------------------------
+    def _unstage(self, tfile, tally):
+        """ hand back a staged file that was not admitted this pass """
+        self._count(tally,'copy_tries',-1)
+        self._count(tally,'deferred')
+        self.manage_lock(tfile,"failed",tally)
+        self._requeue(tfile)
+        mrkfile = ".".join(["/".join([self.trans_dir,tfile]),self.mtype])
+        if not os.path.exists(mrkfile):
+            return
+        try:
+            os.remove(mrkfile)
+        except:
+            self.proc_c.log("OS ERROR removing mrk file for %s" % (tfile),0)
+            self._count(tally,'os_error')
+
+#------------------------
+    def _stopped(self, tfiles, tally, claimed=True):
+        """ once stopping, hand back tfiles instead of starting their transfer and return True """
+        if not self.stopping:
+            return False
+        for tfile in tfiles:
+            if claimed:
+                self._unstage(tfile, tally)
+            else:
+                self._count(tally,'copy_tries',-1)
+                self._requeue(tfile)
+        return True
+
+#------------------------
+    def _marker_failed(self, tfile, tally):
+        """ clean up after the MRK file of tfile could not be copied """
+        localfile="/".join([self.trans_dir,tfile])
+        self._count(tally,'copy_fail')
+        self._count(tally,'mrk_fail')
+        self.proc_c.log("Transfer of marker failed for %s" % (tfile), 0)
+        self.manage_lock(tfile,"failed",tally)
+        self.retries.failed(tfile, "mrk")
+        self._requeue(tfile)
+        if not os.path.exists(".".join([localfile,self.mtype])):
+            return
+        try:
+            os.remove(".".join([localfile,self.mtype]))
+        except:
+            self.proc_c.log("OS ERROR removing mrk file for %s" % (tfile),0)
+            self._count(tally,'os_error')
+
+#------------------------
+    def _finish_transfer(self, tfile, r, etime, tally, offset=0):
+        """ 
+            validate the copied target file and set its lock, or clean up on failure.
+            offset is where a resumed copy started, those bytes were booked when they were kept.
+        """
+        localfile="/".join([self.trans_dir,tfile])
+        v, esize = 0,0
         if r:
             v, esize = self.validate_transfer(localfile)
-            tally['sum_size']+=esize
-            tally['elapsed_time']+=etime
+            self._count(tally,'sum_size',esize)
+            self._count(tally,'elapsed_time',etime)
+            if v == 0 and self.verifier is not None:
+                # --- the verifier thread finishes the file, the caller moves on
+                def verified(ok, checksum):
+                    if ok:
+                        self._transfer_done(tfile, esize, etime, tally, offset)
+                    else:
+                        self._transfer_failed(tfile, r, 3, tally, offset)
+                self.verifier.submit(localfile, marker_checksum(".".join([localfile,self.mtype])), verified)
+                return True
             if v == 0:
-                tally['copy_succ']+=1
-                self.manage_lock(tfile,self.done,tally)
+                self._transfer_done(tfile, esize, etime, tally, offset)
                 return True
-            
-        # --- rest are failed
-        tally['copy_fail']+=1
+        self._transfer_failed(tfile, r, v, tally, offset)
+        return False
+
+#------------------------
+    def _transfer_done(self, tfile, esize, etime, tally, offset):
+        """ count a validated transfer and set its lock to done """
+        self._count(tally,'copy_succ')
+        self._observe(esize - offset, etime)
+        self.checkpoint.finished(tfile)
+        if self.markers is not None:
+            self.markers.forget(tfile)
+        self.retries.succeeded(tfile)
+        if self.space is not None:
+            self.space.add(esize - offset, tfile)
+        self.manage_lock(tfile,self.done,tally)
+
+#------------------------
+    def _transfer_failed(self, tfile, r, v, tally, offset):
+        """ clean up after a failed copy (r False) or validation (v 1: size, 2: MRK file, 3: checksum) """
+        localfile="/".join([self.trans_dir,tfile])
+        self._count(tally,'copy_fail')
         self.manage_lock(tfile,"failed",tally)
+        error = "copy"
+        if r:
+            error = ["validation", "validation", "mrk", "checksum"][v]
+        self.retries.failed(tfile, error)
+        self._requeue(tfile)
 
         self.proc_c.log("Transfer failed = %s" % (tfile), 0) 
+        doomed = [".".join([localfile,self.mtype])]
+        if r or not self._keep_partial(tfile, offset):
+            doomed.append(localfile)
+            if offset > 0 and self.space is not None:
+                self.space.add(-offset, tfile)
         try:
-            os.remove(localfile)
-            os.remove(".".join([localfile,self.mtype]))
+            for afile in doomed:
+                if os.path.exists(afile):
+                    os.remove(afile)
         except:
             self.proc_c.log("OS ERROR removing some file for %s" % (tfile),0)
-            tally['os error']+=1
+            self._count(tally,'os_error')
 
         if v == 2:
-            tally['mrk_fail']+=1
+            self._count(tally,'mrk_fail')
 
-        return False
+#------------------------
+    def _observe(self, esize, etime):
+        """ add a validated transfer to the metrics """
+        self.metrics.inc("files_transferred_total")
+        self.metrics.inc("bytes_transferred_total", esize)
+        self.metrics.observe("transfer_seconds", etime)
+        if etime > 0:
+            self.metrics.observe("transfer_rate_mbps", float(esize) / MEGABYTES / etime)
+
+#------------------------
+    def _requeue(self, tfile):
+        """ make sure a failed file is looked at again on the next pass """
+        if self.listing is not None:
+            self.listing.forget(tfile)
+        if self.markers is not None:
+            self.markers.forget(tfile)
+        self.checkpoint.finished(tfile)
+
+#------------------------
+    def batches(self, tfiles, batch_size):
+        """ group tfiles into lists of up to batch_size files """
+        batch = []
+        for tfile in tfiles:
+            batch.append(tfile)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+#------------------------
+    def ready_files(self, tally, restored=None):
+        """ files in the remote buffer that still need to be transfered, of restored instead of a listing if given """
+        tfiles = restored
+        if tfiles is None:
+            tfiles = self.getfiles(self.remote_dir)
+        if self.shards is not None:
+            # --- before the listing cache, so files of a departed member show up as new
+            self.shards.refresh()
+            tfiles = self.shards.mine(tfiles)
+        if self.listing is not None and restored is None:
+            tfiles = self.listing.candidates(tfiles)
+        nready = 0
+        for chunk in self.batches(tfiles, STATUS_CHUNK):
+            if self.stopping:
+                break
+            ready = []
+            for tfile in self.status.ready(chunk):
+                if not self.retries.eligible(tfile):
+                    self._count(tally,'backoff')
+                    if not self.retries.quarantined(tfile):
+                        self._requeue(tfile)
+                    continue
+                ready.append(tfile)
+            if self.markers is not None:
+                self._prefetch_markers(ready)
+            self.checkpoint.queued(ready)
+            for tfile in ready:
+                if self.stopping:
+                    break
+                self._count(tally,'copy_tries')
+                nready += 1
+                yield tfile
+        self.metrics.set("queue_depth", nready)
+
+#------------------------
+    def _prefetch_markers(self, tfiles):
+        """ copy the MRK files of tfiles that are not in the marker cache yet in one globus-url-copy session """
+        missing = [tfile for tfile in tfiles if not self.markers.has(tfile)]
+        self.markers.load(set(tfiles) - set(missing))
+        if not missing:
+            return
+        fd, listfile = tempfile.mkstemp(prefix="guc_mrk.", suffix=".lst")
+        try:
+            with os.fdopen(fd, "w") as flist:
+                for tfile in missing:
+                    remotefile, localfile, localgridfile = self._local_paths(tfile)
+                    flist.write("%s.%s %s\n" % (remotefile, self.mtype, "/".join([self.local_url,self.markers.path(tfile)])))
+            r, etime = self._call_guc_batch(listfile, self._calc_timeout(None), self._choose(None, batch=True))
+        finally:
+            os.remove(listfile)
+        self.proc_c.log("Prefetched %d of %d marker files in %.1f secs" %
+                        (self.markers.load(missing), len(missing), etime), 1)
+
+#------------------------
+    def transfer_pool(self, transfer, jobs, tally):
+        """
+            run transfer (transfer_file or transfer_batch) over jobs with up to 
+            max_concurrent transfers in flight.  The work queue is bounded by the 
+            number of workers so the listing is only consumed as fast as the workers free up.
+        """
+        work = Queue.Queue(self.max_concurrent)
+
+        def worker():
+            while True:
+                job = work.get()
+                if job is None:
+                    return
+                try:
+                    transfer(job,tally)
+                except Exception as oops:
+                    self._count(tally,'os_error')
+                    self.proc_c.log("Transfer worker failed on %s: %s" % (job, oops), 0)
+
+        workers = []
+        for i in range(self.max_concurrent):
+            t = threading.Thread(target=worker, name="transfer-%d" % (i))
+            t.daemon = True
+            t.start()
+            workers.append(t)
+
+        # --- queue and join with timeouts, a blocked lock would hold off signal handlers
+        def put(job):
+            while True:
+                try:
+                    return work.put(job, True, WATCH_INTERVAL)
+                except Queue.Full:
+                    pass
+        try:
+            for job in jobs:
+                put(job)
+        finally:
+            # --- also when the listing or schedule raise, or the workers would wait forever
+            for t in workers:
+                put(None)
+            for t in workers:
+                while t.is_alive():
+                    t.join(WATCH_INTERVAL)
+
+#------------------------
+    def transfer_pass(self, tally, restored=None):
+        """
+            list, schedule and transfer what fits in the local buffer, False if there was no room.
+            restored, the files pending at a restart, are taken instead of a listing.
+        """
+        if not self.local_space():
+            return False
+        ready = self.ready_files(tally, restored)
+        if self.args.order != "listing":
+            transfer, jobs = self.transfer_data, self.schedule(ready, tally)
+            if self.args.batch_size > 0:
+                transfer, jobs = self.transfer_data_batch, self.batches(jobs, self.args.batch_size)
+        elif self.args.batch_size > 0:
+            transfer, jobs = self.transfer_batch, self.batches(ready, self.args.batch_size)
+        else:
+            transfer, jobs = self.transfer_file, ready
+        if self.max_concurrent > 1:
+            self.transfer_pool(transfer, jobs, tally)
+        else:
+            for job in jobs:
+                transfer(job,tally)
+        return True
+
+#------------------------
+    def save_state(self):
+        """ wait for the verifiers, then save every store, run after each pass and when stopping """
+        if self.verifier is not None:
+            self.verifier.join()
+            self.verifier.save()
+        if self.markers is not None:
+            self.markers.prune()
+        if self.publisher is not None:
+            self.publisher.save()
+        if self.listing is not None:
+            self.listing.save()
+        if self.history is not None:
+            self.history.save()
+        if self.tuner is not None:
+            self.tuner.save()
+        self.retries.save()
+        self.checkpoint.save()
+
+#------------------------
+    def recover(self, tally):
+        """
+            warm restart from the checkpoint: stop the copies left running, finalize the files that
+            were in flight and are complete on disk, and release the rest, keeping their partial data
+            for --resume.  Returns the files pending then and those released, for a first pass before
+            any listing; they are handed back to the listing cache as well, should that pass not get to them.
+        """
+        previous, pending, inflight, commands = self.checkpoint.restored()
+        for pgid, command in commands.items():
+            # --- a copy left running would go on writing the files settled below
+            if not self.proc_c.kill_group(int(pgid), command):
+                self.proc_c.log("Can't stop %s process group %s left by an earlier instance" % (command, pgid), 0)
+        for tfile in pending:
+            self._requeue(tfile)
+        if self.listing is not None:
+            self.listing.save()
+        nfinal = 0
+        requeued = []
+        for tfile in inflight:
+            if previous is None or not self.status.adopt(tfile, previous):
+                continue
+            remotefile, localfile, localgridfile = self._local_paths(tfile)
+            if os.path.isfile(localfile) and self._marker_size(localfile) is not None and \
+                    self.validate_transfer(localfile)[0] == 0:
+                self._finish_transfer(tfile, True, 0, tally)
+                nfinal += 1
+                continue
+            self.manage_lock(tfile,"failed",tally)
+            self._requeue(tfile)
+            doomed = [".".join([localfile,self.mtype])]
+            if not self._keep_partial(tfile, 0):
+                doomed.append(localfile)
+            for afile in doomed:
+                if os.path.exists(afile):
+                    os.remove(afile)
+            requeued.append(tfile)
+        if pending or inflight:
+            self.proc_c.log("Restart: %d pending files to transfer first, of %d in flight %d finalized and %d to transfer again" %
+                            (len(pending), len(inflight), nfinal, len(requeued)), 0)
+        return pending + requeued or None
+
+#------------------------
+    def _drain(self, signum, frame):
+        """ SIGTERM: start no new transfers, finish the ones in flight, save and stop """
+        self.proc_c.log("Signal %d: finishing the transfers in flight, send again to stop at once" % (signum), 0)
+        self.stopping = True
+        self.scheduler.stop()
+        for sig in (SIGTERM, SIGINT):
+            signal(sig, self._stop_now)
+
+#------------------------
+    def _stop_now(self, signum, frame):
+        """ second SIGTERM: kill the running copies and stop """
+        self.proc_c.log("Signal %d: killing the running copies and stopping at once" % (signum), 0)
+        for pgid, command in self.checkpoint.running_commands():
+            self.proc_c.kill_group(pgid, command, 1)
+        os._exit(1)
 
 #------------------------
     def go(self):
@@ -371,10 +1250,16 @@ class transfer_pipeline:
 
 #        A tally for keeping count of various stats
         tally = dict(copy_tries=0, copy_succ = 0, copy_fail = 0, mrk_fail = 0, os_error = 0, 
-                     sum_size=0.0, elapsed_time = 0.0)
+                     deferred = 0, backoff = 0, sum_size=0.0, elapsed_time = 0.0)
+
+        # --- the main thread only waits with timeouts (see comm, transfer_pool), so handlers run at once
+        for sig in (SIGTERM, SIGINT):
+            signal(sig, self._drain)
+            siginterrupt(sig, False)   # --- let reads of running commands carry on through the signal
+        restored = self.recover(tally)
 
         myloop = 0
-        while True:
+        while not self.stopping:
             icount = 0
             myloop += 1
 
@@ -383,21 +1268,30 @@ class transfer_pipeline:
             self.notify()
             if self.held:
                 self.proc_c.log("Found Hold Request, will sleep and check again",0)
-                time.sleep(360)
+                self.scheduler.sleep(HOLD_SLEEP, ["state"])
                 continue
 
             if not self.check_proxy():
                 self.proc_c.log("No valid proxy at Time=%s" % datetime.now(),0)
-                time.sleep(360)
+                self.scheduler.sleep(HOLD_SLEEP, ["proxy"])
+                continue
+            t0 = time.time()
+            tfiles, restored = restored, None
+            try:
+                has_space = self.transfer_pass(tally, tfiles)
+            except Exception as oops:
+                self.proc_c.log("Loop # %d failed: %s" % (myloop, oops), 0)
+                self.proc_c.log(traceback.format_exc(), 1)
+                self.save_state()
+                self.scheduler.sleep(self.args.min_sleep, ["state"])
                 continue
-            if(self.local_space()):
-                for tfile in self.getfiles(self.remote_dir):
-#                    if icount > 2:
-#                        continue
-#                    icount += 1
-                    if self.is_ready_to_transfer(tfile):
-                        tally['copy_tries']+=1
-                        self.transfer_file(tfile,tally)
+            self.save_state()
+            wall_time = time.time() - t0
+            nbackoff, nquarantined = self.retries.summary()
+            self.metrics.set("retry_files", nbackoff, dict(state="backoff"))
+            self.metrics.set("retry_files", nquarantined, dict(state="quarantined"))
+            self.metrics.inc("passes_total")
+            self.metrics.export()
             self.proc_c.log("\n ================================================= \n",0)
             self.proc_c.log("Accumulated Results: loop # %d" % (myloop), 0)
             self.proc_c.log("attempts: %d" % (tally['copy_tries']),0)
@@ -405,6 +1299,13 @@ class transfer_pipeline:
             self.proc_c.log("copy_fail: %d" % (tally['copy_fail']),0)
             self.proc_c.log("mrk_fail: %d" % (tally['mrk_fail']),0)
             self.proc_c.log("OS Errors: %d" % (tally['os_error']),0)
+            if tally['deferred'] > 0:
+                self.proc_c.log("deferred: %d" % (tally['deferred']),0)
+            if tally['backoff'] > 0:
+                self.proc_c.log("held by retry queue: %d" % (tally['backoff']),0)
+            if nbackoff + nquarantined > 0:
+                self.proc_c.log("retry queue: %d backing off, %d quarantined (retry_queue.py %s)" %
+                                (nbackoff, nquarantined, self.retries.queue_file),0)
             if tally['copy_succ'] == 0:
                 size="--"
             else:
@@ -415,8 +1316,18 @@ class transfer_pipeline:
             else:
                 et = "%.3f" % ((tally['sum_size'] / tally['elapsed_time']) / (1 << 20))
             self.proc_c.log("Throughput:   %s MB/sec" % (et), 0)
-            time.sleep(360)
+            if self.max_concurrent > 1 and wall_time > 0:
+                self.proc_c.log("Aggregate:    %.3f MB/sec over %d workers" %
+                                ((tally['sum_size'] / wall_time) / (1 << 20), self.max_concurrent), 0)
+            if not has_space:
+                self.scheduler.sleep(self.args.max_sleep, ["state", "space"])
+            else:
+                # --- after the pass over the restored files, list straight away
+                self.scheduler.sleep(self.scheduler.next_delay(tally['copy_succ'] > 0 or tfiles is not None), ["state"])
 
+        self.save_state()
+        self.proc_c.log("Stopped after loop # %d" % (myloop), 0)
+        return 0
 
 
 def main():
@@ -439,27 +1350,98 @@ def main():
     p.add_argument("--time-to-notify",dest="time_to_notify",default=TIME_TO_NOTIFY,help="how frequent to email notice")
     p.add_argument("--email-addr",dest="email_addr",default=EMAIL_ADDR,help="destination for email notices")
 
+    p.add_argument("--listing-cache",dest="listing_cache",default="None",help="file keeping the remote listing between loops so only new files are checked")
+    p.add_argument("--full-rescan",dest="full_rescan",default=FULL_RESCAN,help="seconds between full rescans when using a listing cache [%(default)s]")
+    p.add_argument("--marker-cache",dest="marker_cache",default="None",help="directory (reachable through --local-url, e.g. under --trans-status) the MRK files of each listing are prefetched into")
+    p.add_argument("--status-db",dest="status_db",default="None",help="sqlite file holding transfer status instead of per file status files (keep on local disk)")
+    p.add_argument("--lease-ttl",dest="lease_ttl",default=LEASE_TTL,help="secs after which an in_progress lease without heartbeat, e.g. of a crashed instance, is reclaimed [%(default)s]")
+    p.add_argument("--node-id",dest="node_id",default="None",help="id of this instance when sharding the remote buffer between instances (heartbeats in trans_status/%s)" % (MEMBERS_DIR))
+    p.add_argument("--members",dest="members",default="None",help="comma separated node ids sharing the buffer, default: every node with a live heartbeat")
+    p.add_argument("--member-ttl",dest="member_ttl",default=MEMBER_TTL,help="secs without heartbeat after which a node's share moves to the others [%(default)s]")
+    p.add_argument("--space-ledger",dest="space_ledger",default="None",help="journal file keeping a running total of the local buffer instead of du each loop")
+    p.add_argument("--reconcile-interval",dest="reconcile_interval",default=RECONCILE_INTERVAL,help="seconds between full du reconciles of the space ledger [%(default)s]")
+    p.add_argument("--min-sleep",dest="min_sleep",default=MIN_SLEEP,help="secs to sleep after a pass that found nothing to do, doubled up to --max-sleep [%(default)s]")
+    p.add_argument("--max-sleep",dest="max_sleep",default=MAX_SLEEP,help="longest sleep between passes [%(default)s]")
+    p.add_argument("--order",dest="order",default="listing",choices=ORDERS,help="transfer order; other than 'listing' files are sized from their MRK file first and admitted against the free buffer [%(default)s]")
+    p.add_argument("--stage-window",dest="stage_window",default=STAGE_WINDOW,help="files sized and ordered per pass when using --order [%(default)s]")
+    p.add_argument("--metrics-port",dest="metrics_port",default=METRICS_PORT,help="serve prometheus metrics over http on this port, 0 => off [%(default)s]")
+    p.add_argument("--metrics-addr",dest="metrics_addr",default=METRICS_ADDR,help="address the metrics port is bound to [%(default)s]")
+    p.add_argument("--metrics-file",dest="metrics_file",default="None",help="prometheus textfile (for the node_exporter textfile collector) rewritten after each loop")
     p.add_argument("--copy-done",dest="copy_done_to_remote",action="store_true", default=False,help="Allows on to copy done file to the remote site")
+    p.add_argument("--done-flush-secs",dest="done_flush_secs",default=FLUSH_SECS,help="secs between pushes of queued done files with --copy-done [%(default)s]")
+    p.add_argument("--done-flush-files",dest="done_flush_files",default=FLUSH_FILES,help="queued done files that trigger a push straight away, and most per session [%(default)s]")
     p.add_argument("--config-file",dest="config_file",default="None",help="override any configs via a json config file")
 
 
 #------- arguments for debuging and others
     p.add_argument("--guc-parallel", dest="guc_parallel", default=GUC_PARALLEL, 
-                    help="parallelism to use in globus-url-copy (-p arg) [%default]")
+                    help="parallelism to use in globus-url-copy (-p arg) [%(default)s]")
+    p.add_argument("--max-concurrent", dest="max_concurrent", default=MAX_CONCURRENT,
+                    help="number of transfers to keep in flight at once [%(default)s]")
+    p.add_argument("--batch-size", dest="batch_size", default=BATCH_SIZE,
+                    help="number of files grouped into one globus-url-copy -f session, 0 => one session per file [%(default)s]")
+    p.add_argument("--guc-concurrency", dest="guc_concurrency", default=GUC_CONCURRENCY,
+                    help="concurrent transfers within a batch session (-cc arg) [%(default)s]")
+    p.add_argument("--guc-pipeline", action="store_true", dest="guc_pipeline", default=False,
+                    help="use globus-url-copy pipelining (-pp) in batch sessions")
+    p.add_argument("--guc-autotune", action="store_true", dest="guc_autotune", default=False,
+                    help="tune -p, -tcp-bs and -cc per file size class from measured throughput")
+    p.add_argument("--guc-parallel-max", dest="guc_parallel_max", default=GUC_PARALLEL_MAX,
+                    help="most parallel streams the tuner may use [%(default)s]")
+    p.add_argument("--guc-concurrency-max", dest="guc_concurrency_max", default=GUC_CONCURRENCY_MAX,
+                    help="most concurrent transfers per batch session the tuner may use [%(default)s]")
+    p.add_argument("--tcp-bs-choices", dest="tcp_bs_choices", default=TCP_BS_CHOICES,
+                    help="tcp buffer sizes the tuner may use, 0 => globus-url-copy default [%(default)s]")
+    p.add_argument("--tuner-file", dest="tuner_file", default=TUNER_FILE,
+                    help="file in the transfer status directory keeping the tuner state [%(default)s]")
     p.add_argument("-n", "--dry-run", action="store_true", dest="dry_run", default=False,
                     help="display but don't run data movement commands")
     p.add_argument("-v", "--verbose", action="count", dest="verbosity", default=0,
                                  help="be verbose about actions, repeatable")
     p.add_argument("-q", "--quiet", action="store_true", dest="quiet", default=False,
                     help="be quiet, suppress normal and verbose output")
+    p.add_argument("--adaptive-timeout", action="store_true", dest="adaptive_timeout", default=False,
+                    help="derive data transfer timeouts from the MRK size and the recent rates "
+                    "seen on the endpoint (kept in --history-file), used instead of --rate-timeout "
+                    "once enough transfers have been seen")
+    p.add_argument("--history-file", dest="history_file", default=HISTORY_FILE,
+                    help="file in the transfer status directory keeping recent transfer rates [%(default)s]")
+    p.add_argument("--timeout-percentile", dest="timeout_percentile", default=TIMEOUT_PERCENTILE,
+                    help="percentile of the recent rates used for adaptive timeouts [%(default)s]")
+    p.add_argument("--timeout-margin", dest="timeout_margin", default=TIMEOUT_MARGIN,
+                    help="safety factor applied to adaptive timeouts [%(default)s]")
+    p.add_argument("--stall-rate", dest="stall_rate", default=STALL_RATE,
+                    help="abort and requeue a transfer whose rate stays below this many MB/s "
+                    "for --stall-window secs [%(default)s].  0 => off")
+    p.add_argument("--stall-window", dest="stall_window", default=STALL_WINDOW,
+                    help="secs a transfer may stay below --stall-rate [%(default)s]")
+    p.add_argument("--verify", dest="verify", default="None", choices=["None"] + ALGORITHMS,
+                    help="checksum transferred files with this algorithm in verifier threads, checked against "
+                    "the MRK file's checksum (any of these algorithms) when it has one [%(default)s]")
+    p.add_argument("--verify-workers", dest="verify_workers", default=VERIFY_WORKERS,
+                    help="verifier threads for --verify [%(default)s]")
+    p.add_argument("--checksum-file", dest="checksum_file", default=CHECKSUM_FILE,
+                    help="file in the transfer status directory caching checksums by path, size and mtime [%(default)s]")
+    p.add_argument("--resume", action="store_true", dest="resume", default=False,
+                    help="keep what a failed copy moved of a large file and continue from there on the next try (single file transfers)")
+    p.add_argument("--resume-min", dest="resume_min", default=RESUME_MIN,
+                    help="MB a failed copy must have moved to be kept for --resume [%(default)s]")
+    p.add_argument("--retry-file", dest="retry_file", default=RETRY_FILE,
+                    help="file in the transfer status directory keeping the failure history [%(default)s]")
+    p.add_argument("--retry-base", dest="retry_base", default=BASE_DELAY,
+                    help="secs a failed file waits before its first retry, doubled with each further failure [%(default)s]")
+    p.add_argument("--retry-max", dest="retry_max", default=MAX_DELAY,
+                    help="longest wait between retries of a failed file [%(default)s]")
+    p.add_argument("--max-failures", dest="max_failures", default=MAX_FAILURES,
+                    help="failures after which a file is quarantined, 0 => never [%(default)s]")
     p.add_argument("--hard-timeout", dest="hard_timeout",
                        default=HARD_TIMEOUT, help="the absolute timeout for "
-                       "a single data transfer command, in seconds [%default]. "
+                       "a single data transfer command, in seconds [%(default)s]. "
                        "0 => no timeout, overrides --rate-timeout.")
     p.add_argument("--rate-timeout", dest="rate_timeout",
                        default=RATE_TIMEOUT, help="calculate timeout for data "
                        "transfer commands based on this transfer rate, in MB/s "
-                       "[%default].  0 => no timeout, minimum calculated "
+                       "[%(default)s].  0 => no timeout, minimum calculated "
                        "timeout used will be " + str(MIN_TIMEOUT) + "secs")
 
     args = p.parse_args()
@@ -486,9 +1468,41 @@ def main():
     try:
         args.hard_timeout = int(args.hard_timeout)
         args.rate_timeout = int(args.rate_timeout)
+        args.stall_window = int(args.stall_window)
     except ValueError:
         p.error("timeout value must be integers")
-        
+    try:
+        args.stall_rate = float(args.stall_rate)
+        args.timeout_percentile = float(args.timeout_percentile)
+        args.timeout_margin = float(args.timeout_margin)
+    except ValueError:
+        p.error("stall-rate, timeout-percentile and timeout-margin must be numbers")
+    try:
+        args.max_concurrent = max(1, int(args.max_concurrent))
+        args.batch_size = int(args.batch_size)
+        args.full_rescan = int(args.full_rescan)
+        args.reconcile_interval = int(args.reconcile_interval)
+        args.min_sleep = int(args.min_sleep)
+        args.max_sleep = int(args.max_sleep)
+        args.stage_window = int(args.stage_window)
+        args.guc_parallel_max = int(args.guc_parallel_max)
+        args.guc_concurrency_max = int(args.guc_concurrency_max)
+        args.metrics_port = int(args.metrics_port)
+        args.retry_base = int(args.retry_base)
+        args.retry_max = int(args.retry_max)
+        args.max_failures = int(args.max_failures)
+        args.resume_min = int(args.resume_min)
+        args.verify_workers = max(1, int(args.verify_workers))
+        args.done_flush_secs = int(args.done_flush_secs)
+        args.done_flush_files = max(1, int(args.done_flush_files))
+        args.lease_ttl = max(3, int(args.lease_ttl))
+        args.member_ttl = max(3, int(args.member_ttl))
+    except ValueError:
+        p.error("max-concurrent, batch-size, full-rescan, reconcile-interval, sleeps, stage-window, tuner bounds, metrics-port, retry settings, resume-min, verify-workers, done-flush settings, lease-ttl and member-ttl must be integers")
+
+    if args.order == "oldest" and args.listing_cache == "None":
+        p.error("--order oldest needs --listing-cache, which records when files were first seen")
+
     try:
         tpl = transfer_pipeline(args)
         return(tpl.go())
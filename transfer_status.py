@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+"""
+Stores for the per-file transfer status used by transfer_pipeline and clean_pipe.
+
+status_files keeps the original layout: one '.in_progress' or '.done' file per target file
+in the transfer status directory.
+
+status_db keeps the same states (in_progress/done/failed, with timestamps) in an indexed
+sqlite table, so a status check is a batched query instead of two stats per file and a
+transfer no longer creates, renames and removes a file on the shared filesystem.  The '.done'
+markers the remote site expects are exported on demand for copying.  Keep the database on a
+local disk, sqlite's WAL mode does not work over network filesystems.
+
+In both stores an in_progress status is a lease held by one process (host:pid).  It is taken
+atomically (O_EXCL create of the status file, or a conditional insert/update of the row), a
+heartbeat thread refreshes the leases a process holds (mtime of the file, 'updated' of the
+row) every lease_ttl/3 secs, and a lease not refreshed for lease_ttl secs, e.g. left by a
+crash, counts as free and is reclaimed by the next claim.
+"""
+import errno, os, socket, sqlite3, threading, time
+
+DONETYPE = "done"
+DOINGTYPE = "in_progress"
+FAILEDTYPE = "failed"
+
+QUERY_CHUNK = 500  # names per IN (...) query, below sqlite's host parameter limit
+LEASE_TTL = 600    # secs an in_progress lease lives without a heartbeat
+
+
+class statusException(Exception):
+    def __init__(self, fname, msg):
+        self.fname = fname
+        self.msg = msg
+    def __str__(self):
+        return "Status change failed for '%s': %s" % (self.fname, self.msg)
+
+
+def open_status(db_file, trans_status, proc_c, lease_ttl=LEASE_TTL):
+    """ status store to use, the sqlite one if a database file was configured """
+    if db_file == "None":
+        return status_files(trans_status, proc_c, lease_ttl)
+    return status_db(db_file, trans_status, proc_c, lease_ttl)
+
+
+class lease_keeper:
+    """ the leases this process holds, refreshed by a heartbeat thread started with the first one """
+
+    def __init__(self, ttl, refresh, proc_c):
+        self.ttl = ttl
+        self.refresh = refresh   # refresh(names) renews the leases on names
+        self.proc_c = proc_c
+        self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        self.held = set()
+        self.thread = None
+        self.beat = threading.Event()
+
+    def hold(self, fname):
+        with self.lock:
+            self.held.add(fname)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._beat, name="lease-heartbeat")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def drop(self, fname):
+        with self.lock:
+            self.held.discard(fname)
+
+    def _beat(self):
+        while True:
+            self.beat.wait(max(1, self.ttl / 3))
+            with self.lock:
+                names = sorted(self.held)
+            if not names:
+                continue
+            try:
+                self.refresh(names)
+                self.proc_c.log("Refreshed %d leases" % (len(names)), 3)
+            except Exception as oops:
+                self.proc_c.log("Lease heartbeat failed: %s" % (oops), 0)
+
+
+class status_files:
+    """ status kept as '.in_progress' and '.done' files in the transfer status directory """
+
+    def __init__(self, trans_status, proc_c, lease_ttl=LEASE_TTL):
+        self.trans_status = trans_status
+        self.proc_c = proc_c
+        self.leases = lease_keeper(lease_ttl, self._refresh, proc_c)
+
+    def _path(self, fname, ltype):
+        return ".".join(["/".join([self.trans_status, fname]), ltype])
+
+    def _stale(self, path):
+        """ True if the lease file at path has missed its heartbeats (or is gone) """
+        try:
+            return os.stat(path).st_mtime < time.time() - self.leases.ttl
+        except OSError:
+            return True
+
+    def ready(self, fnames):
+        """ the names in fnames with neither a done nor a live in_progress status """
+        return [fname for fname in fnames
+                if not os.path.isfile(self._path(fname, DONETYPE))
+                and self._stale(self._path(fname, DOINGTYPE))]
+
+    def _read(self, path):
+        try:
+            with open(path) as lfile:
+                return lfile.read()
+        except IOError:
+            return None
+
+    def _reclaim(self, path):
+        """ move a stale lease out of the way; of several racing claimers only one rename succeeds """
+        before = self._read(path)
+        if before is None or not self._stale(path):
+            return
+        tombstone = "%s.stale.%s" % (path, self.leases.owner)
+        try:
+            os.rename(path, tombstone)
+        except OSError:
+            return
+        if self._read(tombstone) != before:
+            # --- the lease was renewed or retaken meanwhile, put it back
+            try:
+                os.link(tombstone, path)
+            except OSError:
+                pass
+        else:
+            self.proc_c.log("Reclaimed stale lease %s (%s)" % (path, before.strip()), 0)
+        os.remove(tombstone)
+
+    def claim(self, fname):
+        """ take the in_progress lease of fname, False if a live one exists """
+        path = self._path(fname, DOINGTYPE)
+        if os.path.exists(path):
+            self._reclaim(path)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError as oops:
+            if oops.errno != errno.EEXIST:
+                self.proc_c.log("Can't create lease %s: %s" % (path, oops), 0)
+            return False
+        try:
+            os.write(fd, "%s %s\n" % (int(time.time()), self.leases.owner))
+        finally:
+            os.close(fd)
+        self.leases.hold(fname)
+        return True
+
+    def _owned(self, fname):
+        content = self._read(self._path(fname, DOINGTYPE))
+        if content is None or content.split()[-1:] != [self.leases.owner]:
+            raise statusException(fname, "lease lost")
+
+    def _refresh(self, fnames):
+        for fname in fnames:
+            try:
+                os.utime(self._path(fname, DOINGTYPE), None)
+            except OSError as oops:
+                self.proc_c.log("Can't refresh lease of %s: %s" % (fname, oops), 0)
+
+    def adopt(self, fname, previous):
+        """ take over the lease of fname if previous still holds it, e.g. this node before a restart """
+        path = self._path(fname, DOINGTYPE)
+        content = self._read(path)
+        if content is None or content.split()[-1:] != [previous]:
+            return False
+        tmpfile = "%s.%s" % (path, self.leases.owner)
+        with open(tmpfile, "w") as lfile:
+            lfile.write("%s %s\n" % (int(time.time()), self.leases.owner))
+        os.rename(tmpfile, path)
+        self.leases.hold(fname)
+        return True
+
+    def finish(self, fname):
+        self.leases.drop(fname)
+        self._owned(fname)
+        os.rename(self._path(fname, DOINGTYPE), self._path(fname, DONETYPE))
+
+    def release(self, fname):
+        self.leases.drop(fname)
+        self._owned(fname)
+        os.remove(self._path(fname, DOINGTYPE))
+
+    def done_file(self, fname):
+        """ the '.done' marker of fname, to be copied to the remote site """
+        return self._path(fname, DONETYPE)
+
+    def drop_export(self, donefile):
+        """ the done files are the status itself, nothing to drop """
+        pass
+
+    def done_names(self):
+        suffix = "." + DONETYPE
+        for xfile in os.listdir(self.trans_status):
+            if xfile.endswith(suffix):
+                yield xfile[:-len(suffix)]
+
+    def forget(self, fname):
+        os.remove(self._path(fname, DONETYPE))
+
+
+class status_db:
+    """ status kept in a sqlite table (WAL mode), one row per target file """
+
+    def __init__(self, db_file, export_dir, proc_c, lease_ttl=LEASE_TTL):
+        self.export_dir = export_dir
+        self.proc_c = proc_c
+        self.leases = lease_keeper(lease_ttl, self._refresh, proc_c)
+        self.host = self.leases.owner   # --- the lease holder, host:pid
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS transfers ("
+                              "name TEXT PRIMARY KEY, state TEXT NOT NULL, "
+                              "updated INTEGER NOT NULL, host TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS transfers_state ON transfers (state)")
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            with self.conn:
+                return self.conn.execute(sql, params).rowcount
+
+    def ready(self, fnames):
+        """ the names in fnames with neither a done nor a live in_progress status """
+        fnames = list(fnames)
+        busy = set()
+        expired = int(time.time()) - self.leases.ttl
+        with self.lock:
+            for i in range(0, len(fnames), QUERY_CHUNK):
+                chunk = fnames[i:i + QUERY_CHUNK]
+                sql = "SELECT name FROM transfers WHERE (state = ? OR (state = ? AND updated >= ?)) " \
+                      "AND name IN (%s)" % (",".join("?" * len(chunk)))
+                for row in self.conn.execute(sql, [DONETYPE, DOINGTYPE, expired] + chunk):
+                    busy.add(row[0])
+        return [fname for fname in fnames if fname not in busy]
+
+    def claim(self, fname):
+        """ take fname for transfer unless it is already done or holds a live in_progress lease """
+        now = int(time.time())
+        with self.lock:
+            with self.conn:
+                n = self.conn.execute("INSERT OR IGNORE INTO transfers VALUES (?, ?, ?, ?)",
+                                      (fname, DOINGTYPE, now, self.host)).rowcount
+                if n == 0:
+                    n = self.conn.execute("UPDATE transfers SET state = ?, updated = ?, host = ? "
+                                          "WHERE name = ? AND (state = ? OR (state = ? AND updated < ?))",
+                                          (DOINGTYPE, now, self.host, fname, FAILEDTYPE,
+                                           DOINGTYPE, now - self.leases.ttl)).rowcount
+        if n > 0:
+            self.leases.hold(fname)
+        return n > 0
+
+    def adopt(self, fname, previous):
+        """ take over the lease of fname if previous still holds it, e.g. this node before a restart """
+        if self._execute("UPDATE transfers SET updated = ?, host = ? WHERE name = ? AND state = ? AND host = ?",
+                         (int(time.time()), self.host, fname, DOINGTYPE, previous)) == 0:
+            return False
+        self.leases.hold(fname)
+        return True
+
+    def _refresh(self, fnames):
+        now = int(time.time())
+        for i in range(0, len(fnames), QUERY_CHUNK):
+            chunk = fnames[i:i + QUERY_CHUNK]
+            self._execute("UPDATE transfers SET updated = ? WHERE state = ? AND host = ? AND name IN (%s)" %
+                          (",".join("?" * len(chunk))), [now, DOINGTYPE, self.host] + chunk)
+
+    def _change(self, fname, state):
+        self.leases.drop(fname)
+        n = self._execute("UPDATE transfers SET state = ?, updated = ? WHERE name = ? AND state = ? AND host = ?",
+                          (state, int(time.time()), fname, DOINGTYPE, self.host))
+        if n == 0:
+            raise statusException(fname, "not in progress or lease lost")
+
+    def finish(self, fname):
+        self._change(fname, DONETYPE)
+
+    def release(self, fname):
+        self._change(fname, FAILEDTYPE)
+
+    def done_file(self, fname):
+        """
+            write out a '.done' marker for fname in the usual layout, to be copied to the remote site;
+            None once fname is no longer done (e.g. clean_pipe forgot it meanwhile)
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM transfers WHERE name = ? AND state = ?",
+                                    (fname, DONETYPE)).fetchone()
+        if row is None:
+            return None
+        donefile = ".".join(["/".join([self.export_dir, fname]), DONETYPE])
+        with open(donefile, "w") as dfile:
+            dfile.write("%s\n" % (int(time.time())))
+        return donefile
+
+    def drop_export(self, donefile):
+        """ the exported marker has been copied, the database still holds the status """
+        os.remove(donefile)
+
+    def done_names(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT name FROM transfers WHERE state = ?", (DONETYPE,)).fetchall()
+        for row in rows:
+            yield row[0]
+
+    def forget(self, fname):
+        if self._execute("DELETE FROM transfers WHERE name = ? AND state = ?", (fname, DONETYPE)) == 0:
+            raise statusException(fname, "not done")